@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+"""
+Alertmanager Client
+
+Shared HTTP client for the backup CPU alert scripts. Keeps one pooled
+keep-alive session per process with timeouts and retries, so repeated API
+calls reuse the TLS connection to Alertmanager instead of reconnecting.
+
+Silence lookups ask Alertmanager to filter by matcher and drop expired
+silences, and the IDs of silences created here are kept in a small state file
+so they can be fetched or expired directly by ID.
+
+Lookups and expiries go to all Alertmanager cluster peers at once and return
+as soon as QUORUM of them confirm it, so one slow or restarting replica
+neither blocks nor fails a call. Silence lists from the peers are merged by
+ID. A silence is created on one peer, failing over to the next one that is
+reachable, and reaches the others by gossip.
+"""
+
+import json
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+ALERTMANAGER_URL = "https://alertmanager-prod.goepp.net/api/v2"
+
+# Alertmanager cluster peers, comma separated API URLs
+ALERTMANAGER_PEERS = [
+    url.strip()
+    for url in os.environ.get("ALERTMANAGER_PEERS", ALERTMANAGER_URL).split(",")
+    if url.strip()
+]
+
+# Peers that must confirm a call, a majority by default
+QUORUM = int(os.environ.get("ALERTMANAGER_QUORUM", len(ALERTMANAGER_PEERS) // 2 + 1))
+
+# (connect, read) timeout in seconds for every request
+TIMEOUT = (5, 30)
+
+# Alertmanager matcher filter selecting silences with a CPU alertname matcher
+CPU_FILTER = 'alertname=~"(?i).*cpu.*"'
+
+# Silence states that still matter, expired silences are never returned
+LIVE_STATES = ("active", "pending")
+
+# IDs of silences created by these scripts
+STATE_PATH = os.environ.get(
+    "BACKUP_CPU_ALERT_STATE",
+    os.path.join(os.path.expanduser("~"), ".backup_cpu_alert_silences.json"),
+)
+
+_session = None
+
+
+class QuorumError(requests.exceptions.RequestException):
+    """Fewer peers than the quorum confirmed a call"""
+
+
+class TimeoutSession(requests.Session):
+    """requests.Session that applies a default timeout to every request"""
+
+    def __init__(self, timeout):
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return super().request(method, url, **kwargs)
+
+
+def get_session(pool_size=8, retries=3, backoff=0.5):
+    """Return the shared pooled session, creating it on first use
+
+    GET and DELETE are retried with backoff on errors and 5xx responses, POST
+    only on connection errors so a silence is never created twice.
+    """
+    global _session
+    if _session is None:
+        session = TimeoutSession(TIMEOUT)
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=(429, 500, 502, 503, 504),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=len(ALERTMANAGER_PEERS),
+            pool_maxsize=pool_size,
+            max_retries=retry,
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        _session = session
+    return _session
+
+
+def fan_out(method, path, ok=(200,), quorum=None, **kwargs):
+    """Send one call to every peer at once, return the responses of the first
+    quorum peers that confirm it with a status in ok
+
+    Slower peers are not waited for. Raises QuorumError once too many peers
+    have failed for the quorum to be reached.
+    """
+    peers = ALERTMANAGER_PEERS
+    quorum = min(quorum or QUORUM, len(peers))
+    results = queue.Queue()
+
+    def call(peer):
+        try:
+            results.put(get_session().request(method, f"{peer}{path}", **kwargs))
+        except requests.exceptions.RequestException as e:
+            results.put(e)
+
+    for peer in peers:
+        threading.Thread(target=call, args=(peer,), daemon=True).start()
+
+    confirmed, errors = [], []
+    for _ in peers:
+        result = results.get()
+        if isinstance(result, Exception):
+            errors.append(str(result))
+        elif result.status_code in ok:
+            confirmed.append(result)
+        else:
+            errors.append(f"{result.url}: HTTP {result.status_code}")
+
+        if len(confirmed) >= quorum:
+            return confirmed
+        if len(errors) > len(peers) - quorum:
+            break
+
+    raise QuorumError(
+        f"{len(confirmed)} of {quorum} peers confirmed {method} {path}: "
+        + "; ".join(errors)
+    )
+
+
+def fail_over(method, path, ok=(200,), **kwargs):
+    """Send one call to the peers in turn until one confirms it with a status in
+    ok, return its response
+
+    A peer passes the call on only if it couldn't be reached or answered with
+    a 5xx. A read timeout raises instead, the peer may have acted on the call.
+    Raises QuorumError if no peer confirmed it.
+    """
+    errors = []
+    for peer in ALERTMANAGER_PEERS:
+        try:
+            response = get_session().request(method, f"{peer}{path}", **kwargs)
+        except requests.exceptions.ConnectionError as e:
+            errors.append(str(e))
+            continue
+        if response.status_code in ok:
+            return response
+        errors.append(f"{response.url}: HTTP {response.status_code}")
+        # Every peer would reject the call the same way
+        if response.status_code < 500:
+            break
+
+    raise QuorumError(f"No peer confirmed {method} {path}: " + "; ".join(errors))
+
+
+def merge_silences(silences):
+    """De-duplicate silences from several peers by ID, keeping the newest copy"""
+    merged = {}
+    for silence in silences:
+        current = merged.get(silence["id"])
+        if current is None or silence.get("updatedAt", "") > current.get(
+            "updatedAt", ""
+        ):
+            merged[silence["id"]] = silence
+    return list(merged.values())
+
+
+def create_silence(silence):
+    """Create a silence on the first peer that takes it, returns its ID
+
+    The cluster gossips it to the other peers, so there is exactly one copy to
+    look up and expire.
+    """
+    response = fail_over(
+        "POST",
+        "/silences",
+        headers={"Content-Type": "application/json"},
+        json=silence,
+    )
+    return response.json()["silenceID"]
+
+
+def get_silences(filters=(CPU_FILTER,), states=LIVE_STATES):
+    """Silences matching the matcher filters that are in one of states
+
+    Alertmanager applies the filters, it has no state parameter so expired
+    silences are dropped here.
+    """
+    responses = fan_out("GET", "/silences", params={"filter": list(filters)})
+    return [
+        s
+        for s in merge_silences(s for r in responses for s in r.json())
+        if s.get("status", {}).get("state") in states
+    ]
+
+
+def get_silence(silence_id):
+    """One silence by ID, None if Alertmanager doesn't know it"""
+    responses = fan_out("GET", f"/silence/{silence_id}", ok=(200, 404))
+    silences = merge_silences(r.json() for r in responses if r.status_code == 200)
+    return silences[0] if silences else None
+
+
+def load_silence_ids():
+    """IDs of silences created by these scripts"""
+    try:
+        with open(STATE_PATH) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return []
+
+
+def save_silence_ids(silence_ids):
+    try:
+        with open(STATE_PATH + ".tmp", "w") as f:
+            json.dump(silence_ids, f)
+        os.replace(STATE_PATH + ".tmp", STATE_PATH)
+    except OSError as e:
+        print(f"! Could not save silence state to {STATE_PATH}: {e}")
+
+
+def remember_silence(silence_id):
+    """Record a silence created by these scripts"""
+    silence_ids = load_silence_ids()
+    if silence_id not in silence_ids:
+        save_silence_ids(silence_ids + [silence_id])
+
+
+def get_tracked_silences(states=LIVE_STATES):
+    """Silences created by these scripts that are in one of states
+
+    Each is fetched by ID in parallel, IDs of silences that expired or no
+    longer exist are dropped from the state file.
+    """
+    silence_ids = load_silence_ids()
+    if not silence_ids:
+        return []
+
+    with ThreadPoolExecutor(max_workers=min(8, len(silence_ids))) as executor:
+        silences = list(executor.map(get_silence, silence_ids))
+
+    live = [
+        s for s in silences if s is not None and s["status"]["state"] in LIVE_STATES
+    ]
+    if len(live) < len(silence_ids):
+        save_silence_ids([s["id"] for s in live])
+    return [s for s in live if s["status"]["state"] in states]
+
+
+def expire_silences(silence_ids):
+    """Expire silences in parallel, returns (silence_id, error) per silence
+
+    error is None when the silence was expired.
+    """
+
+    def expire(silence_id):
+        try:
+            # A peer that hasn't heard of a new silence yet gets the expiry by gossip
+            responses = fan_out(
+                "DELETE", f"/silence/{silence_id}", ok=(200, 204, 404)
+            )
+        except requests.exceptions.RequestException as e:
+            return silence_id, str(e)
+        if all(r.status_code == 404 for r in responses):
+            return silence_id, "HTTP 404"
+        return silence_id, None
+
+    if not silence_ids:
+        return []
+    with ThreadPoolExecutor(max_workers=min(8, len(silence_ids))) as executor:
+        results = list(executor.map(expire, silence_ids))
+
+    expired = {silence_id for silence_id, error in results if error is None}
+    tracked = load_silence_ids()
+    if not expired.isdisjoint(tracked):
+        save_silence_ids([i for i in tracked if i not in expired])
+    return results
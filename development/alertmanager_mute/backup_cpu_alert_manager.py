@@ -9,6 +9,13 @@ Usage:
     python backup_cpu_alert_manager.py start [duration_minutes]  # Create silence
     python backup_cpu_alert_manager.py stop                     # Remove all CPU silences
     python backup_cpu_alert_manager.py status                   # Show active silences
+    python backup_cpu_alert_manager.py daemon schedule.json     # Run scheduled windows
+    python backup_cpu_alert_manager.py matchers [mode]          # Dry run the matchers
+
+Daemon mode stays resident and keeps silences in place for every window in a
+schedule file (see maintenance_schedule.py). Silences for the next
+PLAN_AHEAD_HOURS are created ahead of time with a future startsAt, so
+Alertmanager starts and ends them on time by itself.
     
 Example cron entries:
     # Start maintenance at 4:00 AM for 15 minutes
@@ -18,98 +25,132 @@ Example cron entries:
     0 4 * * * timeout 15m /usr/bin/python3 /path/to/backup_cpu_alert_manager.py monitor
 """
 
+import re
 import requests
 import sys
+import threading
 import time
 import signal
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone, timedelta
 
-ALERTMANAGER_URL = "https://alertmanager-prod.goepp.net/api/v2"
+from alertmanager_client import (
+    LIVE_STATES,
+    QuorumError,
+    create_silence,
+    expire_silences,
+    get_silences,
+    get_tracked_silences,
+    remember_silence,
+)
+from cpu_matchers import CATCH_ALL_MATCHERS, cpu_matcher_sets, dry_run
+from maintenance_schedule import load_schedule
+
+# Daemon mode: how far ahead silences are created, and how often it re-plans
+PLAN_AHEAD_HOURS = 24
+PLAN_INTERVAL_SECONDS = 15 * 60
+DAEMON_CREATED_BY = "Maintenance Window Daemon"
+
+
+def window_tag(name, starts_at):
+    """Comment prefix tying a daemon silence to one window occurrence"""
+    return f"[{name} {starts_at.isoformat()}]"
+
+
+def parse_window_tag(comment):
+    """(name, starts_at) from a daemon silence comment, None if it has no tag"""
+    match = re.match(r"\[(\S+) (\S+)\]", comment or "")
+    if match is None:
+        return None
+    return match.group(1), datetime.fromisoformat(match.group(2))
 
 
 class BackupCPUAlertManager:
     def __init__(self):
         self.silence_id = None
 
-    def create_silence(self, duration_minutes=15):
-        """Create a silence for CPU-related alerts"""
-        start_time = datetime.now(timezone.utc).isoformat()
-        end_time = (
-            datetime.now(timezone.utc) + timedelta(minutes=duration_minutes)
-        ).isoformat()
-
-        headers = {"Content-Type": "application/json"}
+    def create_silence(
+        self,
+        duration_minutes=15,
+        matchers=CATCH_ALL_MATCHERS,
+        starts_at=None,
+        comment=None,
+        created_by="Backup CPU Alert Manager",
+        remember=True,
+    ):
+        """Create a silence, for CPU-related alerts starting now by default
+
+        Remembered silences are the ones stop and status look up by ID.
+        """
+        if starts_at is None:
+            starts_at = datetime.now(timezone.utc)
+        start_time = starts_at.isoformat()
+        end_time = (starts_at + timedelta(minutes=duration_minutes)).isoformat()
+        if comment is None:
+            comment = f"Automated backup CPU alert silence - {duration_minutes} minutes"
 
         data = {
-            "matchers": [
-                {
-                    "name": "alertname",
-                    "value": ".*CPU.*|.*cpu.*|.*Cpu.*",
-                    "isRegex": True,
-                    "isEqual": True,
-                }
-            ],
+            "matchers": matchers,
             "startsAt": start_time,
             "endsAt": end_time,
-            "createdBy": "Backup CPU Alert Manager",
-            "comment": f"Automated backup CPU alert silence - {duration_minutes} minutes",
+            "createdBy": created_by,
+            "comment": comment,
         }
 
         try:
-            response = requests.post(
-                f"{ALERTMANAGER_URL}/silences", headers=headers, json=data
-            )
-            if response.status_code in [200, 201]:
-                self.silence_id = response.json().get("silenceID")
-                print(f"✓ CPU alert silence created (ID: {self.silence_id})")
-                print(f"  Duration: {duration_minutes} minutes")
-                return self.silence_id
-            else:
-                print(f"✗ Error creating silence: HTTP {response.status_code}")
-                print(f"  Response: {response.text}")
-                return None
+            self.silence_id = create_silence(data)
+            if remember:
+                remember_silence(self.silence_id)
+            print(f"✓ Silence created (ID: {self.silence_id})")
+            print(f"  Start: {start_time}")
+            print(f"  Duration: {duration_minutes:.0f} minutes")
+            return self.silence_id
+        except QuorumError as e:
+            print(f"✗ Error creating silence: {e}")
+            return None
         except requests.exceptions.RequestException as e:
             print(f"✗ Network error: {e}")
             return None
 
+    def create_cpu_silences(self, duration_minutes=15):
+        """Create the CPU silences for CPU_MATCHER_MODE, one per matcher set
+
+        Returns the silence IDs, None if any of them couldn't be created.
+        """
+        silence_ids = [
+            self.create_silence(duration_minutes, matchers=matchers)
+            for matchers in cpu_matcher_sets()
+        ]
+        return silence_ids if all(silence_ids) else None
+
+    def find_cpu_silences(self, states=("active", "pending")):
+        """CPU silences created by this tool, or any CPU silence if none are tracked
+
+        Tracked silences are fetched by ID, otherwise Alertmanager filters the
+        silence list down to CPU matchers.
+        """
+        silences = get_tracked_silences(states)
+        if silences:
+            return silences
+        return get_silences(states=states)
+
     def remove_cpu_silences(self):
         """Remove all active CPU-related silences"""
         try:
-            # Get all active silences
-            response = requests.get(f"{ALERTMANAGER_URL}/silences")
-            if response.status_code != 200:
-                print(f"✗ Error fetching silences: HTTP {response.status_code}")
-                return False
-
-            silences = response.json()
-            cpu_silences = [
-                s
-                for s in silences
-                if s.get("status", {}).get("state") == "active"
-                and any(
-                    "cpu" in str(matcher.get("value", "")).lower()
-                    for matcher in s.get("matchers", [])
-                )
-            ]
+            cpu_silences = self.find_cpu_silences(states=("active",))
 
             if not cpu_silences:
                 print("! No active CPU silences to remove")
                 return True
 
-            # Remove each CPU silence
+            # Remove the CPU silences in parallel
             removed_count = 0
-            for silence in cpu_silences:
-                silence_id = silence.get("id")
-                delete_response = requests.delete(
-                    f"{ALERTMANAGER_URL}/silence/{silence_id}"
-                )
-                if delete_response.status_code in [200, 204]:
+            for silence_id, error in expire_silences([s["id"] for s in cpu_silences]):
+                if error is None:
                     print(f"✓ Removed silence {silence_id}")
                     removed_count += 1
                 else:
-                    print(
-                        f"✗ Failed to remove silence {silence_id}: HTTP {delete_response.status_code}"
-                    )
+                    print(f"✗ Failed to remove silence {silence_id}: {error}")
 
             print(f"✓ Removed {removed_count} CPU silence(s)")
             return removed_count > 0
@@ -119,22 +160,9 @@ class BackupCPUAlertManager:
             return False
 
     def show_status(self):
-        """Show status of CPU-related silences"""
+        """Show status of active and pending CPU-related silences"""
         try:
-            response = requests.get(f"{ALERTMANAGER_URL}/silences")
-            if response.status_code != 200:
-                print(f"✗ Error fetching silences: HTTP {response.status_code}")
-                return
-
-            silences = response.json()
-            cpu_silences = [
-                s
-                for s in silences
-                if any(
-                    "cpu" in str(matcher.get("value", "")).lower()
-                    for matcher in s.get("matchers", [])
-                )
-            ]
+            cpu_silences = self.find_cpu_silences()
 
             if not cpu_silences:
                 print("! No CPU-related silences found")
@@ -154,6 +182,92 @@ class BackupCPUAlertManager:
         except requests.exceptions.RequestException as e:
             print(f"✗ Network error: {e}")
 
+    def plan_windows(self, windows):
+        """Make sure every window occurrence in the next PLAN_AHEAD_HOURS has a silence
+
+        Missing silences are created in one parallel batch, an occurrence already
+        running gets a silence starting now. An occurrence only ever gets one, so
+        a running window whose silence was expired is not silenced again.
+        Pending silences of occurrences no longer in the schedule are expired.
+        """
+        now = datetime.now(timezone.utc)
+        wanted = {}
+        for window in windows:
+            for starts_at, ends_at in window.occurrences(
+                now, now + timedelta(hours=PLAN_AHEAD_HOURS)
+            ):
+                wanted[(window.name, starts_at)] = (window, starts_at, ends_at)
+
+        # An occurrence can have several silences, e.g. copies a create that
+        # went to every peer left behind. Expired ones count for occurrences that
+        # have started, so a window someone ended early stays ended.
+        existing = {}
+        for silence in get_silences(filters=(), states=LIVE_STATES + ("expired",)):
+            if silence.get("createdBy") == DAEMON_CREATED_BY:
+                key = parse_window_tag(silence.get("comment"))
+                if key is None:
+                    continue
+                if silence["status"]["state"] == "expired" and key[1] > now:
+                    continue
+                existing.setdefault(key, []).append(silence)
+
+        def create(occurrence):
+            window, starts_at, ends_at = occurrence
+            silence_start = max(starts_at, now)
+            return self.create_silence(
+                (ends_at - silence_start).total_seconds() / 60,
+                matchers=window.matchers,
+                starts_at=silence_start,
+                comment=f"{window_tag(window.name, starts_at)} {window.comment}".strip(),
+                created_by=DAEMON_CREATED_BY,
+                remember=False,
+            )
+
+        missing = [wanted[key] for key in sorted(wanted) if key not in existing]
+        if missing:
+            print(f"Creating {len(missing)} silence(s) for upcoming windows")
+            with ThreadPoolExecutor(max_workers=min(8, len(missing))) as executor:
+                list(executor.map(create, missing))
+
+        stale = [
+            silence["id"]
+            for key, silences in existing.items()
+            if key not in wanted
+            for silence in silences
+            if silence["status"]["state"] == "pending"
+        ]
+        for silence_id, error in expire_silences(stale):
+            if error is None:
+                print(f"✓ Removed silence {silence_id} of an unscheduled window")
+            else:
+                print(f"✗ Failed to remove silence {silence_id}: {error}")
+
+    def daemon_mode(self, schedule_path):
+        """Keep silences in place for every window in a schedule file until stopped
+
+        The schedule file is read again on every pass, so edits take effect
+        without a restart.
+        """
+        print(f"🔧 Starting maintenance window daemon with {schedule_path}...")
+        stop = threading.Event()
+
+        def signal_handler(signum, frame):
+            print(f"\n🛑 Received signal {signum}, stopping")
+            stop.set()
+
+        signal.signal(signal.SIGTERM, signal_handler)
+        signal.signal(signal.SIGINT, signal_handler)
+
+        while not stop.is_set():
+            try:
+                windows = load_schedule(schedule_path)
+                self.plan_windows(windows)
+            except (OSError, ValueError, KeyError) as e:
+                print(f"✗ Error loading schedule {schedule_path}: {e}")
+            except requests.exceptions.RequestException as e:
+                print(f"✗ Network error: {e}")
+            stop.wait(PLAN_INTERVAL_SECONDS)
+
     def monitor_mode(self, duration_minutes=15):
         """Run in monitor mode - create silence and wait for duration"""
         print(
@@ -170,7 +284,7 @@ class BackupCPUAlertManager:
         signal.signal(signal.SIGINT, signal_handler)
 
         # Create silence
-        if not self.create_silence(duration_minutes):
+        if not self.create_cpu_silences(duration_minutes):
             print("❌ Failed to create silence, exiting")
             sys.exit(1)
 
@@ -196,11 +310,15 @@ def main():
         print(
             "Usage: backup_cpu_alert_manager.py {start|stop|status|monitor} [duration_minutes]"
         )
+        print("       backup_cpu_alert_manager.py daemon schedule.json")
+        print("       backup_cpu_alert_manager.py matchers [regex|exact|per-alert]")
         print("\nCommands:")
         print("  start [duration]  - Create CPU alert silence (default: 15 min)")
         print("  stop              - Remove all CPU alert silences")
         print("  status            - Show status of CPU silences")
         print("  monitor [duration]- Run maintenance mode (create, wait, cleanup)")
+        print("  daemon schedule   - Keep silences in place for every scheduled window")
+        print("  matchers [mode]   - Dry run: show the matchers and the alerts they catch")
         sys.exit(1)
 
     command = sys.argv[1].lower()
@@ -218,7 +336,7 @@ def main():
                 print("Duration must be a valid integer")
                 sys.exit(1)
 
-        result = manager.create_silence(duration)
+        result = manager.create_cpu_silences(duration)
         sys.exit(0 if result else 1)
 
     elif command == "stop":
@@ -242,6 +360,20 @@ def main():
 
         manager.monitor_mode(duration)
 
+    elif command == "daemon":
+        if len(sys.argv) < 3:
+            print("Daemon mode needs a schedule file")
+            sys.exit(1)
+
+        manager.daemon_mode(sys.argv[2])
+
+    elif command == "matchers":
+        try:
+            dry_run(*sys.argv[2:3])
+        except ValueError as e:
+            print(e)
+            sys.exit(1)
+
     else:
         print(f"Unknown command: {command}")
         sys.exit(1)
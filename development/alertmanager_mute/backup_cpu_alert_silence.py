@@ -15,28 +15,25 @@ import requests
 import sys
 from datetime import datetime, timezone, timedelta
 
-ALERTMANAGER_URL = "https://alertmanager-prod.goepp.net/api/v2"
+from alertmanager_client import (
+    QuorumError,
+    create_silence,
+    get_silences,
+    remember_silence,
+)
+from cpu_matchers import CATCH_ALL_MATCHERS, cpu_matcher_sets
 
 
-def create_cpu_silence(duration_minutes=15):
+def create_cpu_silence(duration_minutes=15, matchers=CATCH_ALL_MATCHERS):
     """Create a silence for CPU-related alerts"""
     start_time = datetime.now(timezone.utc).isoformat()
     end_time = (
         datetime.now(timezone.utc) + timedelta(minutes=duration_minutes)
     ).isoformat()
 
-    headers = {"Content-Type": "application/json"}
-
     # Create silence for CPU-related alerts
     data = {
-        "matchers": [
-            {
-                "name": "alertname",
-                "value": ".*CPU.*|.*cpu.*|.*Cpu.*",
-                "isRegex": True,
-                "isEqual": True,
-            }
-        ],
+        "matchers": matchers,
         "startsAt": start_time,
         "endsAt": end_time,
         "createdBy": "Backup CPU Alert Script",
@@ -44,21 +41,17 @@ def create_cpu_silence(duration_minutes=15):
     }
 
     try:
-        response = requests.post(
-            f"{ALERTMANAGER_URL}/silences", headers=headers, json=data
-        )
-        if response.status_code in [200, 201]:
-            silence_id = response.json().get("silenceID")
-            print(f"✓ CPU alert silence created successfully")
-            print(f"  Silence ID: {silence_id}")
-            print(f"  Duration: {duration_minutes} minutes")
-            print(f"  Start: {start_time}")
-            print(f"  End: {end_time}")
-            return silence_id
-        else:
-            print(f"✗ Error creating silence: HTTP {response.status_code}")
-            print(f"  Response: {response.text}")
-            return None
+        silence_id = create_silence(data)
+        remember_silence(silence_id)
+        print(f"✓ CPU alert silence created successfully")
+        print(f"  Silence ID: {silence_id}")
+        print(f"  Duration: {duration_minutes} minutes")
+        print(f"  Start: {start_time}")
+        print(f"  End: {end_time}")
+        return silence_id
+    except QuorumError as e:
+        print(f"✗ Error creating silence: {e}")
+        return None
     except requests.exceptions.RequestException as e:
         print(f"✗ Network error: {e}")
         return None
@@ -67,29 +60,19 @@ def create_cpu_silence(duration_minutes=15):
 def list_active_silences():
     """List all active silences to verify our silence is active"""
     try:
-        response = requests.get(f"{ALERTMANAGER_URL}/silences")
-        if response.status_code == 200:
-            silences = response.json()
-            active_cpu_silences = [
-                s
-                for s in silences
-                if s.get("status", {}).get("state") == "active"
-                and any(
-                    "cpu" in str(matcher.get("value", "")).lower()
-                    for matcher in s.get("matchers", [])
-                )
-            ]
-
-            if active_cpu_silences:
-                print(f"\n✓ Found {len(active_cpu_silences)} active CPU silence(s):")
-                for silence in active_cpu_silences:
-                    print(f"  ID: {silence.get('id')}")
-                    print(f"  Comment: {silence.get('comment')}")
-                    print(f"  Ends: {silence.get('endsAt')}")
-            else:
-                print("\n! No active CPU silences found")
+        # Alertmanager filters by matcher, only active ones are kept
+        active_cpu_silences = get_silences(states=("active",))
+
+        if active_cpu_silences:
+            print(f"\n✓ Found {len(active_cpu_silences)} active CPU silence(s):")
+            for silence in active_cpu_silences:
+                print(f"  ID: {silence.get('id')}")
+                print(f"  Comment: {silence.get('comment')}")
+                print(f"  Ends: {silence.get('endsAt')}")
         else:
-            print(f"✗ Error fetching silences: HTTP {response.status_code}")
+            print("\n! No active CPU silences found")
+    except QuorumError as e:
+        print(f"✗ Error fetching silences: {e}")
     except requests.exceptions.RequestException as e:
         print(f"✗ Network error fetching silences: {e}")
 
@@ -110,9 +93,12 @@ def main():
 
     print(f"Creating CPU alert silence for {duration} minutes...")
 
-    silence_id = create_cpu_silence(duration)
+    # One silence, or one per alert name with CPU_MATCHER_MODE=per-alert
+    silence_ids = [
+        create_cpu_silence(duration, matchers) for matchers in cpu_matcher_sets()
+    ]
 
-    if silence_id:
+    if all(silence_ids):
         print(f"\n🔇 CPU alerts silenced for {duration} minutes")
         list_active_silences()
     else:
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""
+CPU Alert Matchers
+
+Builds the matchers of a CPU silence. The default is the catch-all regex
+.*CPU.*|.*cpu.*|.*Cpu.*, which Alertmanager evaluates against every alert and
+which misses other spellings. With CPU_MATCHER_MODE set, the CPU alert names
+are looked up instead, from the alerts Alertmanager currently has and from a
+Prometheus rules file (ALERT_RULES_FILE, scanned for "alert:" lines). Every
+name containing "cpu" in any case is kept, and the silence uses either:
+
+    exact      one alertname=~"A|B|C" matcher listing exactly those names
+    per-alert  one alertname="A" silence per name
+
+Names are cached in a JSON file (CPU_MATCHER_CACHE) between runs. Alerts
+that aren't firing when the names are looked up stay covered that way. The
+cache is refreshed after CACHE_TTL_HOURS and used as is when the sources
+can't be read.
+"""
+
+import json
+import os
+import re
+import time
+
+import requests
+
+from alertmanager_client import fan_out
+
+CATCH_ALL_MATCHERS = [
+    {
+        "name": "alertname",
+        "value": ".*CPU.*|.*cpu.*|.*Cpu.*",
+        "isRegex": True,
+        "isEqual": True,
+    }
+]
+
+MODES = ("regex", "exact", "per-alert")
+MATCHER_MODE = os.environ.get("CPU_MATCHER_MODE", "regex")
+RULES_FILE = os.environ.get("ALERT_RULES_FILE")
+CACHE_PATH = os.environ.get(
+    "CPU_MATCHER_CACHE",
+    os.path.join(os.path.expanduser("~"), ".backup_cpu_alert_names.json"),
+)
+CACHE_TTL_HOURS = 6
+
+ALERT_RULE = re.compile(r"^\s*(?:-\s*)?alert:\s*[\"']?([^\"'\s#]+)")
+
+
+def is_cpu_alert(name):
+    """The one check for a CPU-related alert name"""
+    return "cpu" in name.lower()
+
+
+def alert_names_from_alertmanager():
+    """Names of the alerts Alertmanager currently has"""
+    responses = fan_out("GET", "/alerts")
+    return {
+        alert["labels"]["alertname"]
+        for response in responses
+        for alert in response.json()
+        if "alertname" in alert.get("labels", {})
+    }
+
+
+def alert_names_from_rules(path):
+    """Names of the alerting rules in a Prometheus rules file"""
+    with open(path) as f:
+        return {match.group(1) for match in map(ALERT_RULE.match, f) if match}
+
+
+def load_cache():
+    try:
+        with open(CACHE_PATH) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"updated": 0, "names": []}
+
+
+def save_cache(names):
+    try:
+        with open(CACHE_PATH + ".tmp", "w") as f:
+            json.dump({"updated": time.time(), "names": sorted(names)}, f)
+        os.replace(CACHE_PATH + ".tmp", CACHE_PATH)
+    except OSError as e:
+        print(f"! Could not save alert name cache to {CACHE_PATH}: {e}")
+
+
+def cpu_alert_names(rules_file=RULES_FILE, refresh=False):
+    """CPU alert names from the cache, looked up again once it is stale
+
+    Names found by a lookup are added to the cached ones, so alerts that were
+    firing on an earlier run stay in the set.
+    """
+    cache = load_cache()
+    names = set(cache["names"])
+    if not refresh and time.time() - cache["updated"] < CACHE_TTL_HOURS * 3600:
+        return names
+
+    found = lookup_alert_names(rules_file)
+    if found is not None:
+        names |= {name for name in found if is_cpu_alert(name)}
+        save_cache(names)
+    return names
+
+
+def lookup_alert_names(rules_file=RULES_FILE):
+    """All alert names from Alertmanager and the rules file, None if neither
+    could be read"""
+    found = set()
+    looked_up = False
+    try:
+        found |= alert_names_from_alertmanager()
+        looked_up = True
+    except requests.exceptions.RequestException as e:
+        print(f"! Could not read alerts from Alertmanager: {e}")
+    if rules_file:
+        try:
+            found |= alert_names_from_rules(rules_file)
+            looked_up = True
+        except OSError as e:
+            print(f"! Could not read rules file {rules_file}: {e}")
+    return found if looked_up else None
+
+
+def build_matcher_sets(names, mode=MATCHER_MODE):
+    """Matchers for each silence to create, the catch-all regex when no names
+    are known or in regex mode"""
+    if mode not in MODES:
+        raise ValueError(f"CPU_MATCHER_MODE must be one of {', '.join(MODES)}")
+    if mode == "regex" or not names:
+        return [CATCH_ALL_MATCHERS]
+    if mode == "exact":
+        return [
+            [
+                {
+                    "name": "alertname",
+                    "value": "|".join(re.escape(name) for name in sorted(names)),
+                    "isRegex": True,
+                    "isEqual": True,
+                }
+            ]
+        ]
+    return [
+        [{"name": "alertname", "value": name, "isRegex": False, "isEqual": True}]
+        for name in sorted(names)
+    ]
+
+
+def cpu_matcher_sets(mode=MATCHER_MODE):
+    """Matchers for each CPU silence to create in the configured mode"""
+    if mode == "regex":
+        return [CATCH_ALL_MATCHERS]
+    return build_matcher_sets(cpu_alert_names(), mode)
+
+
+def matches(matchers, name):
+    """Whether an alertname passes every alertname matcher of a silence"""
+    for matcher in matchers:
+        if matcher["name"] != "alertname":
+            continue
+        if matcher["isRegex"]:
+            hit = re.fullmatch(matcher["value"], name) is not None
+        else:
+            hit = matcher["value"] == name
+        if hit != matcher.get("isEqual", True):
+            return False
+    return True
+
+
+def format_matcher(matcher):
+    operator = "=~" if matcher["isRegex"] else "="
+    if not matcher.get("isEqual", True):
+        operator = "!~" if matcher["isRegex"] else "!="
+    return f'{matcher["name"]}{operator}"{matcher["value"]}"'
+
+
+def dry_run(mode=MATCHER_MODE, rules_file=RULES_FILE):
+    """Print the matchers the mode would create and the alerts they catch,
+    without creating anything or touching the cache"""
+    known = lookup_alert_names(rules_file) or set()
+    names = set(load_cache()["names"]) | {n for n in known if is_cpu_alert(n)}
+    known |= names
+
+    matcher_sets = build_matcher_sets(names, mode)
+    print(f"Mode: {mode}, {len(matcher_sets)} silence(s)")
+    for matchers in matcher_sets:
+        caught = sorted(name for name in known if matches(matchers, name))
+        print("  " + ", ".join(format_matcher(m) for m in matchers))
+        print(f"    catches: {', '.join(caught) if caught else 'no known alerts'}")
+
+    missed = sorted(
+        name
+        for name in known
+        if is_cpu_alert(name) and not matches(CATCH_ALL_MATCHERS, name)
+    )
+    if missed:
+        print(f"  Missed by the catch-all regex: {', '.join(missed)}")
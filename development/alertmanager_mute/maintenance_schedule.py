@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+Maintenance Window Schedule
+
+Loads the schedule file used by the alert manager daemon and works out when
+each maintenance window occurs. A schedule file looks like:
+
+    {
+        "timezone": "America/New_York",
+        "windows": [
+            {
+                "name": "backup-cpu",
+                "cron": "0 4 * * *",
+                "duration_minutes": 15,
+                "matchers": [
+                    {"name": "alertname", "value": ".*CPU.*", "isRegex": true}
+                ],
+                "comment": "Nightly backup"
+            }
+        ]
+    }
+
+Cron expressions have the usual five fields (minute hour day-of-month month
+day-of-week) with *, lists, ranges and steps, evaluated in the schedule's
+timezone.
+"""
+
+import json
+import re
+from datetime import timedelta, timezone
+from zoneinfo import ZoneInfo
+
+CRON_FIELDS = [
+    ("minute", 0, 59),
+    ("hour", 0, 23),
+    ("day", 1, 31),
+    ("month", 1, 12),
+    ("weekday", 0, 7),
+]
+# Window names go into the comment tag of their silences, "[name starts_at]"
+WINDOW_NAME = re.compile(r"[\w.-]+")
+
+
+def parse_cron_field(field, low, high):
+    """Set of values allowed by one cron field"""
+    values = set()
+    for part in field.split(","):
+        part, _, step = part.partition("/")
+        if part == "*":
+            start, end = low, high
+        elif "-" in part:
+            start, end = map(int, part.split("-"))
+        else:
+            start = end = int(part)
+            if step:
+                end = high
+        if start < low or end > high or start > end:
+            raise ValueError(f"Cron field out of range: {field}")
+        values.update(range(start, end + 1, int(step) if step else 1))
+    return values
+
+
+class CronExpression:
+    """A five field cron expression"""
+
+    def __init__(self, expression):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"Cron expression needs 5 fields: {expression}")
+        self.expression = expression
+        self.minute, self.hour, self.day, self.month, self.weekday = [
+            parse_cron_field(field, low, high)
+            for field, (_, low, high) in zip(fields, CRON_FIELDS)
+        ]
+        # 0 and 7 are both Sunday
+        if 7 in self.weekday:
+            self.weekday = (self.weekday - {7}) | {0}
+        # Like cron, a restricted day of month and day of week match either
+        self.any_day = fields[2] == "*" or fields[4] == "*"
+
+    def matches(self, moment):
+        """Whether a local datetime falls on this expression"""
+        if (
+            moment.minute not in self.minute
+            or moment.hour not in self.hour
+            or moment.month not in self.month
+        ):
+            return False
+        day = moment.day in self.day
+        weekday = (moment.weekday() + 1) % 7 in self.weekday
+        return (day and weekday) if self.any_day else (day or weekday)
+
+    def occurrences(self, start, end, tz):
+        """Times in [start, end) this expression fires, as UTC datetimes"""
+        moment = start.astimezone(timezone.utc).replace(second=0, microsecond=0)
+        if moment < start:
+            moment += timedelta(minutes=1)
+        while moment < end:
+            if self.matches(moment.astimezone(tz)):
+                yield moment
+            moment += timedelta(minutes=1)
+
+
+class MaintenanceWindow:
+    """One scheduled window: when it starts, how long it lasts and what it silences"""
+
+    def __init__(self, config, tz):
+        self.name = config["name"]
+        self.cron = CronExpression(config["cron"])
+        self.duration = timedelta(minutes=int(config["duration_minutes"]))
+        self.matchers = config["matchers"]
+        self.comment = config.get("comment", "")
+        self.tz = tz
+        for matcher in self.matchers:
+            matcher.setdefault("isRegex", False)
+            matcher.setdefault("isEqual", True)
+
+    def occurrences(self, start, end):
+        """(starts_at, ends_at) of every occurrence still running at start or
+        starting before end"""
+        for starts_at in self.cron.occurrences(start - self.duration, end, self.tz):
+            if starts_at + self.duration > start:
+                yield starts_at, starts_at + self.duration
+
+
+def load_schedule(path):
+    """Maintenance windows from a schedule file"""
+    with open(path) as f:
+        schedule = json.load(f)
+    tz = ZoneInfo(schedule.get("timezone", "UTC"))
+    windows = [MaintenanceWindow(window, tz) for window in schedule["windows"]]
+    names = [window.name for window in windows]
+    for name in names:
+        if not WINDOW_NAME.fullmatch(name):
+            raise ValueError(
+                f"Maintenance window name {name!r} may only use letters, digits, "
+                "_ . and -"
+            )
+    if len(set(names)) != len(names):
+        raise ValueError("Maintenance window names must be unique")
+    return windows
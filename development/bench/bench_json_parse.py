@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+JSON parse micro-benchmark for IoTaWatt /query pages
+
+Compares the old per-page handling (response.json() parsed four times with the
+stdlib decoder, then a Python loop per sample) against the current one (a single
+parse with orjson when installed, then split_rows into typed arrays).
+
+Usage:
+    python bench_json_parse.py [pages]
+"""
+
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "iotawatt"))
+
+from samples import json_loads, orjson, split_rows  # noqa: E402
+
+ROWS = 5000
+
+
+def make_page(columns):
+    """Synthetic 1m IoTaWatt page with a limit continuation"""
+    start = 1_700_000_000
+    data = [
+        [start + i * 60] + [round(random.uniform(0, 5000), 2) for _ in range(columns)]
+        for i in range(ROWS)
+    ]
+    end = start + ROWS * 60
+    return json.dumps(
+        {"range": [start, end], "labels": [], "data": data, "limit": end}
+    ).encode()
+
+
+def before(body, columns):
+    """Old handling, one response.json() call per access"""
+    if "limit" in json.loads(body).keys():
+        pass
+    if json.loads(body)["data"] == []:
+        return
+    data = json.loads(body)["data"]
+    for column in range(1, columns + 1):
+        values = []
+        timestamps = []
+        for entry in data:
+            values.append(float(entry[column]))
+            timestamps.append(int(entry[0] * 1000))
+    json.loads(body)
+
+
+def after(body, columns):
+    """Current handling, one parse and array conversion"""
+    page = json_loads(body)
+    if page["data"] == []:
+        return
+    split_rows(page["data"], [0] * columns)
+    page.get("limit")
+
+
+def measure(handler, body, columns, pages):
+    started = time.process_time()
+    for _ in range(pages):
+        handler(body, columns)
+    return (time.process_time() - started) / pages * 1000
+
+
+def main():
+    pages = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    print(f"Decoder: {'orjson' if orjson is not None else 'json (stdlib)'}")
+    print(f"{ROWS} rows per page, {pages} pages per run, CPU ms per page")
+    for columns in (1, 14):
+        body = make_page(columns)
+        old = measure(before, body, columns, pages)
+        new = measure(after, body, columns, pages)
+        print(
+            f"  {columns:2d} column(s), {len(body) / 1024:.0f} KiB: "
+            f"before {old:.2f} ms, after {new:.2f} ms ({old / new:.1f}x)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Output backend micro-benchmark: JSON import vs Prometheus remote write
+
+Encodes the same series the way each writer does before POSTing them, JSON
+lines gzipped for /api/v1/import and snappy compressed protobuf for
+/api/v1/write, without any HTTP. Reports CPU seconds per million samples and
+bytes per sample before and after compression, i.e. on the wire.
+
+Usage:
+    python bench_output_backends.py [million_samples]
+"""
+
+import os
+import random
+import sys
+import time
+from array import array
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "iotawatt"))
+
+from channel_labels import LabelSet  # noqa: E402
+import remote_write  # noqa: E402
+from samples import orjson  # noqa: E402
+from vm_import import RemoteWriteWriter, VMImportWriter  # noqa: E402
+
+CHANNELS = 28
+BLOCK = 5000
+
+
+def make_series(samples):
+    """Blocks of 1m power readings per channel, like one sync pass writes"""
+    start = 1_700_000_000_000
+    series = []
+    per_channel = samples // CHANNELS
+    for channel in range(CHANNELS):
+        label_set = LabelSet(
+            {
+                "__name__": "power",
+                "location": f"Channel_{channel}",
+                "source": "iotawatt",
+                "device": "iwatt5",
+                "type": "Circuit",
+            }
+        )
+        watts = random.uniform(0, 3000)
+        for block in range(0, per_channel, BLOCK):
+            first = start + block * 60000
+            timestamps = array("q", range(first, first + BLOCK * 60000, 60000))
+            values = array("d")
+            for _ in timestamps:
+                watts = max(0.0, watts + random.gauss(0, 50))
+                values.append(round(watts, 2))
+            series.append((label_set, timestamps, values))
+    return series
+
+
+def measure(writer, series, batch_bytes=4 * 1024 * 1024):
+    """CPU seconds, encoded bytes and compressed bytes for the series"""
+    started = time.process_time()
+    raw = wire = 0
+    batch, size = [], 0
+    for metric, timestamps, values in series:
+        line = writer.encode(metric, timestamps, values)
+        batch.append(line)
+        size += len(line) + 1
+        raw += len(line)
+        if size >= batch_bytes:
+            wire += len(writer.body(batch))
+            batch, size = [], 0
+    if batch:
+        wire += len(writer.body(batch))
+    return time.process_time() - started, raw, wire
+
+
+def main():
+    millions = float(sys.argv[1]) if len(sys.argv) > 1 else 2
+    random.seed(1)
+    series = make_series(int(millions * 1_000_000))
+    samples = sum(len(timestamps) for _, timestamps, _ in series)
+
+    print(f"JSON encoder: {'orjson' if orjson is not None else 'json (stdlib)'}")
+    print(f"{samples:,} samples in {len(series)} series of up to {BLOCK}")
+    if remote_write.snappy is None:
+        print("! python-snappy is not installed, only measuring JSON")
+    writers = [("import (JSON + gzip)", VMImportWriter("http://stand-in"))]
+    if remote_write.snappy is not None:
+        writers.append(
+            ("remote_write (protobuf + snappy)", RemoteWriteWriter("http://stand-in"))
+        )
+
+    for name, writer in writers:
+        cpu, raw, wire = measure(writer, series)
+        print(f"  {name}")
+        print(f"    CPU:      {cpu / samples * 1_000_000:.2f} s per million samples")
+        print(f"    Encoded:  {raw / samples:.1f} bytes/sample")
+        print(
+            f"    On wire:  {wire / samples:.2f} bytes/sample "
+            f"({wire / 1024 / 1024:.1f} MiB)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+"""
+Offline sync and backfill benchmarks
+
+Starts the stand-ins from stand_ins.py in a separate process, points
+vm_iotawatt_sync.py and vm_iotawatt_transform.py at them and runs a full
+catch-up over the simulated history. The stand-ins run out of process so CPU
+time and peak RSS below belong to the scripts only.
+
+Reported per run: rows/sec imported, requests per pass to each server, CPU time
+and peak RSS of this process.
+
+The repair benchmark punches gaps into what the sync imported (a whole day of
+every channel, two hours of one channel and three single minutes) and runs
+vm_iotawatt_repair.py to find and fill them.
+
+Usage:
+    python run_benchmarks.py [--days 365] [--latency 0.0] [--failure-rate 0.0]
+                             [--only sync|backfill|repair] [--resolution 1m|5s]
+                             [--backend import|remote_write]
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from urllib.request import Request, urlopen
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "iotawatt"))
+
+import vm_iotawatt_repair as repair  # noqa: E402
+import vm_iotawatt_sync as sync  # noqa: E402
+import vm_iotawatt_transform as transform  # noqa: E402
+from spool import Spool  # noqa: E402
+from sync_state import SyncState  # noqa: E402
+from vm_import import make_writer  # noqa: E402
+
+
+def start_stand_ins(args):
+    """Run stand_ins.py in a child process and return it with its URLs"""
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            os.path.join(HERE, "stand_ins.py"),
+            "--days",
+            str(args.days),
+            "--latency",
+            str(args.latency),
+            "--failure-rate",
+            str(args.failure_rate),
+        ]
+        + (["--keep-samples"] if args.only in (None, "repair") else []),
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    info = json.loads(process.stdout.readline())
+    return process, info["urls"], info["data_start"]
+
+
+def call(url, path, method="GET"):
+    """JSON response of a stand-in endpoint, the query string goes in path"""
+    with urlopen(Request(f"{url}{path}", method=method)) as response:
+        return json.loads(response.read() or b"{}")
+
+
+def reset_stats(urls):
+    for url in urls.values():
+        call(url, "/_reset", "POST")
+
+
+def collect_stats(urls):
+    return {name: call(url, "/_stats") for name, url in urls.items()}
+
+
+def report(name, stats, wall, cpu, passes):
+    """Print one benchmark result"""
+    rows = stats["victoriametrics"]["rows_in"]
+    print(f"\n{name}")
+    print(f"  Rows imported:   {rows:,}")
+    print(f"  Wall time:       {wall:.1f}s ({rows / wall:,.0f} rows/s)")
+    print(f"  CPU time:        {cpu:.1f}s ({cpu / max(rows, 1) * 1e6:.2f} us/row)")
+    print(f"  Peak RSS:        {peak_rss_mb():.0f} MiB")
+    print(f"  Passes:          {passes}")
+    for server, server_stats in stats.items():
+        requests = sum(server_stats["requests"].values())
+        if requests:
+            detail = ", ".join(f"{k}: {v}" for k, v in server_stats["requests"].items())
+            print(
+                f"  {server:<15}  {requests / passes:,.1f} requests/pass, "
+                f"{server_stats['bytes_in'] / 1024:,.0f} KiB sent, "
+                f"{server_stats['failures']} injected failures ({detail})"
+            )
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def bench_sync(urls, data_start):
+    """Catch up every channel from the start of the simulated history
+
+    Passes repeat while a channel is still behind or spooled series are still
+    waiting for a successful import.
+    """
+    sync.victoriametrics_server = urls["victoriametrics"]
+    sync.iotawatt_urls = {host: urls[host] for host in sync.measurements_all}
+    start_day = datetime.fromtimestamp(data_start, timezone.utc).date().isoformat()
+    sync.default_start = {host: start_day for host in sync.measurements_all}
+    sync.writer = make_writer(
+        urls["victoriametrics"], sync.output_backend, session=sync.vm_session
+    )
+    sync.watermarks = sync.Watermarks()
+    sync.rollups = sync.Rollups()
+
+    with tempfile.TemporaryDirectory() as directory:
+        sync.spool = Spool(directory)
+        reset_stats(urls)
+        wall, cpu = time.monotonic(), time.process_time()
+        passes = 0
+        while passes < 1000:
+            passes += 1
+            behind = sync.sync_all()
+            caught_up = sync.max_lag(sync.channels_all, time.time()) < 180
+            if not behind and caught_up and sync.spool.size() == 0:
+                break
+        wall, cpu = time.monotonic() - wall, time.process_time() - cpu
+    report("Sync catch-up", collect_stats(urls), wall, cpu, passes)
+
+
+def bench_backfill(urls, data_start):
+    """Backfill every channel of the simulated history through the transform"""
+    start_day = datetime.fromtimestamp(data_start, timezone.utc).isoformat()
+    transform.vm_url = urls["victoriametrics"]
+    transform.start_times = {host: start_day for host in transform.measurements_all}
+    transform.end_time = datetime.now(timezone.utc).isoformat()
+
+    with tempfile.TemporaryDirectory() as directory:
+        state = SyncState(os.path.join(directory, "state.db"))
+        writer = make_writer(
+            urls["victoriametrics"],
+            transform.output_backend,
+            max_bytes=16 * 1024 * 1024,
+            max_age=60,
+            session=transform.vm_session,
+        )
+
+        reset_stats(urls)
+        wall, cpu = time.monotonic(), time.process_time()
+        left = transform.backfill(state, writer)
+        wall, cpu = time.monotonic() - wall, time.process_time() - cpu
+        state.close()
+    report(
+        f"Backfill ({transform.source_mode})", collect_stats(urls), wall, cpu, 1
+    )
+    if left:
+        print(f"  Chunks left:     {left} failed, a rerun would retry them")
+    return left
+
+
+def bench_repair(urls, data_start):
+    """Punch gaps into the synced history and repair them
+
+    Needs the sync benchmark to have run first and at least a week of history.
+    """
+    day = 86400
+    gaps = [
+        (data_start + 2 * day + 1, data_start + 3 * day, None),
+        (data_start + 4 * day + 7141, data_start + 4 * day + 3 * 3600, "Office"),
+        (data_start + 5 * day + 541, data_start + 5 * day + 600, "Mains_1"),
+        (data_start + 5 * day + 1141, data_start + 5 * day + 1200, "Mains_1"),
+        (data_start + 6 * day + 241, data_start + 6 * day + 300, "Mains_1"),
+    ]
+    forgotten = 0
+    for start, end, location in gaps:
+        path = f"/_forget?start={start:.0f}&end={end:.0f}"
+        if location is not None:
+            path += f"&location={location}"
+        forgotten += call(urls["victoriametrics"], path, "POST")["forgotten"]
+
+    repair.dry_run = False
+    repair.repair_days = 0
+    reset_stats(urls)
+    wall, cpu = time.monotonic(), time.process_time()
+    found, failed = repair.repair()
+    wall, cpu = time.monotonic() - wall, time.process_time() - cpu
+    stats = collect_stats(urls)
+
+    repair.dry_run = True
+    left, _ = repair.repair()
+
+    vm = stats["victoriametrics"]
+    missing = sum(
+        (last - first + 1) // 60 for ranges in found.values() for first, last in ranges
+    )
+    devices = sum(stats[host]["rows_out"] for host in sync.measurements_all)
+    print("\nRepair")
+    print(f"  Samples removed: {forgotten:,} (all series, incl. rollups)")
+    print(
+        f"  Gaps found:      {sum(map(len, found.values()))} in {len(found)} "
+        f"channels, {missing:,} missing minutes"
+    )
+    print(f"  Rows imported:   {vm['rows_in']:,}, {devices:,} rows read from devices")
+    print(f"  Wall time:       {wall:.2f}s, CPU time {cpu:.2f}s")
+    for server, server_stats in stats.items():
+        if server_stats["requests"]:
+            detail = ", ".join(f"{k}: {v}" for k, v in server_stats["requests"].items())
+            print(f"  {server:<15}  {detail}")
+    print(
+        f"  Left after:      {sum(map(len, left.values()))} gaps, "
+        f"{len(failed)} channels failed"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--days", type=float, default=365, help="days of history")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds per request")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="share of 503s")
+    parser.add_argument("--only", choices=["sync", "backfill", "repair"])
+    parser.add_argument(
+        "--resolution", choices=["1m", "5s"], default="1m", help="sync resolution"
+    )
+    parser.add_argument(
+        "--backend",
+        choices=["import", "remote_write"],
+        default="import",
+        help="output backend of the sync, repair and backfill",
+    )
+    args = parser.parse_args()
+
+    sync.default_resolution = args.resolution
+    sync.output_backend = transform.output_backend = args.backend
+    sync.logger.setLevel("ERROR")
+    transform.logger.setLevel("ERROR")
+    repair.logger.setLevel("ERROR")
+
+    process, urls, data_start = start_stand_ins(args)
+    left = 0
+    try:
+        print(
+            f"{args.days:g} days of simulated history at {args.resolution} "
+            f"to {args.backend}, "
+            f"{args.latency * 1000:g} ms latency, {args.failure_rate:.0%} failures"
+        )
+        if args.only in (None, "sync", "repair"):
+            bench_sync(urls, data_start)
+        if args.only in (None, "backfill"):
+            left = bench_backfill(urls, data_start)
+        if args.only in (None, "repair") and args.days >= 7:
+            bench_repair(urls, data_start)
+    finally:
+        process.terminate()
+    if left:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
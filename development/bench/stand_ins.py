@@ -0,0 +1,586 @@
+#!/usr/bin/env python3
+"""
+Local stand-ins for IoTaWatt, VictoriaMetrics and Alertmanager
+
+Small HTTP servers that fake just enough of each API to run the sync, backfill
+and silence scripts offline:
+
+    IoTaWatt        /query (multi-column select, 1m/5s groups, limit pagination)
+    VictoriaMetrics /api/v1/query, /api/v1/query_range (and minutes with data
+                    in imported samples), /api/v1/export, /api/v1/import,
+                    /api/v1/write (remote write, needs python-snappy)
+    Alertmanager    /api/v2/silences (with matcher filters), /api/v2/silence/{id},
+                    /api/v2/alerts
+
+Data is synthetic and deterministic. Every server accepts a fixed latency and a
+failure rate (HTTP 503) for fault injection, and exposes GET /_stats with
+request, row (served and imported) and byte counters plus POST /_reset.
+
+With --keep-samples VictoriaMetrics keeps the timestamps it imports, so
+count_over_time((max(present_over_time(...[1m])) by (location))[Ns:1m])
+queries see them, and POST /_forget?start=&end=[&location=] drops the ones in
+a time range to punch gaps into the imported history.
+
+Usage:
+    python stand_ins.py [--days 30] [--latency 0.01] [--failure-rate 0.0]
+                        [--keep-samples]
+
+Prints a JSON line with the server URLs, then serves until interrupted.
+"""
+
+import argparse
+import bisect
+import gzip
+import json
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from array import array
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+GROUPS = {"1m": 60, "5s": 5}
+
+
+def synthetic_value(timestamp, column):
+    """Deterministic watts for a channel column at a timestamp"""
+    return round(((timestamp // 5) * (column * 7919 + 104729)) % 500000 / 100, 2)
+
+
+def parse_time(value):
+    """Unix seconds from a query parameter (unix time or ISO date)"""
+    try:
+        return float(value)
+    except ValueError:
+        parsed = datetime.fromisoformat(value)
+        if parsed.tzinfo is None:
+            parsed = parsed.replace(tzinfo=timezone.utc)
+        return parsed.timestamp()
+
+
+def read_varint(data, position):
+    value = shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if byte < 0x80:
+            return value, position
+
+
+def read_fields(data):
+    """(field number, wire type, value) of every field in a protobuf message,
+    only the wire types remote write uses"""
+    position = 0
+    while position < len(data):
+        key, position = read_varint(data, position)
+        number, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, position = read_varint(data, position)
+        elif wire_type == 1:
+            value, position = data[position : position + 8], position + 8
+        elif wire_type == 2:
+            length, position = read_varint(data, position)
+            value, position = data[position : position + length], position + length
+        else:
+            raise ValueError(f"Unexpected wire type {wire_type}")
+        yield number, wire_type, value
+
+
+def decode_write_request(body):
+    """(labels, timestamps) of every TimeSeries in a remote write WriteRequest"""
+    series = []
+    for number, _, timeseries in read_fields(body):
+        if number != 1:
+            continue
+        labels, timestamps = {}, []
+        for field, _, value in read_fields(timeseries):
+            if field == 1:
+                label = {n: v.decode() for n, _, v in read_fields(value)}
+                labels[label[1]] = label[2]
+            elif field == 2:
+                timestamps.append(
+                    next(v for n, _, v in read_fields(value) if n == 2)
+                )
+        series.append((labels, timestamps))
+    return series
+
+
+def silence_matches(silence, matcher):
+    """Whether a silence passes one name=~"regex" style filter matcher"""
+    name, operator, value = re.match(r'(\w+)(=~|!~|!=|=)"(.*)"$', matcher).groups()
+    patterns = {m["name"]: m["value"] for m in silence.get("matchers", [])}
+    if name not in patterns:
+        return False
+    if operator in ("=~", "!~"):
+        return bool(re.fullmatch(value, patterns[name])) == (operator == "=~")
+    return (patterns[name] == value) == (operator == "=")
+
+
+class StandIn(ThreadingHTTPServer):
+    """Threaded HTTP server with latency, failure injection and counters"""
+
+    daemon_threads = True
+
+    def __init__(self, handler, port=0, latency=0.0, failure_rate=0.0):
+        super().__init__(("127.0.0.1", port), handler)
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.lock = threading.Lock()
+        self.reset()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_port}"
+
+    def reset(self):
+        with self.lock:
+            self.stats = {
+                "requests": {},
+                "failures": 0,
+                "rows_out": 0,
+                "rows_in": 0,
+                "bytes_in": 0,
+            }
+
+    def count(self, key, amount=1):
+        with self.lock:
+            self.stats[key] += amount
+
+    def forget(self, query):
+        return 0
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Routes requests to do_<name> handlers after latency and failure injection"""
+
+    routes = {}
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def handle_any(self, method):
+        url = urlparse(self.path)
+        self.query = parse_qs(url.query)
+        length = int(self.headers.get("Content-Length", 0))
+        self.body = self.rfile.read(length) if length else b""
+
+        if url.path == "/_stats" and method == "GET":
+            with self.server.lock:
+                return self.send_json(self.server.stats)
+        if url.path == "/_reset" and method == "POST":
+            self.server.reset()
+            return self.send_json({})
+        if url.path == "/_forget" and method == "POST":
+            return self.send_json({"forgotten": self.server.forget(self.query)})
+
+        with self.server.lock:
+            requests = self.server.stats["requests"]
+            key = f"{method} {self.route_name(url.path)}"
+            requests[key] = requests.get(key, 0) + 1
+        self.server.count("bytes_in", len(self.body))
+
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if random.random() < self.server.failure_rate:
+            self.server.count("failures")
+            return self.send_json({"error": "injected failure"}, status=503)
+
+        for prefix, name in self.routes.items():
+            if url.path == prefix or url.path.startswith(prefix + "/"):
+                return getattr(self, f"{method.lower()}_{name}")(url.path)
+        return self.send_json({"error": "not found"}, status=404)
+
+    def route_name(self, path):
+        for prefix, name in self.routes.items():
+            if path == prefix or path.startswith(prefix + "/"):
+                return prefix
+        return path
+
+    def do_GET(self):
+        self.handle_any("GET")
+
+    def do_POST(self):
+        self.handle_any("POST")
+
+    def do_DELETE(self):
+        self.handle_any("DELETE")
+
+    def send_body(self, body, status=200, content_type="application/json"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, obj, status=200):
+        self.send_body(json.dumps(obj).encode(), status)
+
+
+class IoTaWattHandler(Handler):
+    """IoTaWatt /query with data from data_start until now"""
+
+    routes = {"/query": "query"}
+
+    def get_query(self, path):
+        columns = self.query["select"][0].strip("[]").split(",")[1:]
+        step = GROUPS[self.query.get("group", ["1m"])[0]]
+        limit = int(self.query.get("limit", ["5000"])[0])
+        end = self.query.get("end", ["s"])[0]
+        end = time.time() if end == "s" else parse_time(end)
+        begin = max(parse_time(self.query["begin"][0]), self.server.data_start)
+        first = int(-(-begin // step) * step)
+        last = int(end // step * step)
+
+        times = range(first, last + 1, step)
+        page = {
+            "range": [first, last],
+            "labels": ["Time"] + columns,
+            "data": [
+                [t] + [synthetic_value(t, c) for c in range(len(columns))]
+                for t in times[:limit]
+            ],
+        }
+        if len(times) > limit:
+            page["limit"] = times[limit]
+
+        self.server.count("rows_out", len(page["data"]))
+        self.send_json(page)
+
+
+class VictoriaMetricsHandler(Handler):
+    """VictoriaMetrics query, export and import endpoints"""
+
+    routes = {
+        "/api/v1/query_range": "query_range",
+        "/api/v1/query": "query",
+        "/api/v1/export": "export",
+        "/api/v1/import": "import",
+        "/api/v1/write": "write",
+    }
+
+    def source_series(self, match):
+        """Old Power_<measurement> series, 1m data from data_start"""
+        measurement = match.split("{")[0].removeprefix("Power_")
+        return {"__name__": f"Power_{measurement}"}, sum(map(ord, measurement))
+
+    def get_query(self, path):
+        with self.server.lock:
+            last_times = dict(self.server.last_times)
+        now = time.time()
+        # max(...) by (location)
+        by_location = {}
+        for (_, location), last_time in last_times.items():
+            by_location[location] = max(last_time, by_location.get(location, 0))
+        self.send_json(
+            {
+                "status": "success",
+                "data": {
+                    "resultType": "vector",
+                    "result": [
+                        {
+                            "metric": {"location": location},
+                            "value": [now, str(last_time // 1000)],
+                        }
+                        for location, last_time in by_location.items()
+                    ],
+                },
+            }
+        )
+
+    def get_query_range(self, path):
+        if self.query["query"][0].startswith("count_over_time((max(present_over_time("):
+            return self.count_minutes()
+        metric, column = self.source_series(self.query["query"][0])
+        step = GROUPS.get(self.query.get("step", ["1m"])[0], 60)
+        start = max(parse_time(self.query["start"][0]), self.server.data_start)
+        end = min(parse_time(self.query["end"][0]), time.time())
+        first = int(-(-start // step) * step)
+        values = [
+            [t, str(synthetic_value(t, column))] for t in range(first, int(end) + 1, step)
+        ]
+        self.server.count("rows_out", len(values))
+        self.send_json(
+            {
+                "status": "success",
+                "data": {
+                    "resultType": "matrix",
+                    "result": [{"metric": metric, "values": values}] if values else [],
+                },
+            }
+        )
+
+    def count_minutes(self):
+        """count_over_time((max(present_over_time(selector[1m])) by (location))
+        [Ns:1m]), the minutes with kept samples per location and window. Points
+        without any are left out like VictoriaMetrics does."""
+        query = self.query["query"][0]
+        names = re.search(r'__name__=~"([^"]+)"', query).group(1)
+        window = int(re.search(r"\[(\d+)s:1m\]", query).group(1))
+        step = int(self.query["step"][0].rstrip("s"))
+        start = int(parse_time(self.query["start"][0]))
+        end = int(parse_time(self.query["end"][0]))
+
+        by_location = {}
+        for (name, _, location), minutes in self.server.minutes().items():
+            if re.fullmatch(names, name or ""):
+                by_location.setdefault(location, set()).update(minutes)
+
+        result = []
+        for location, minutes in by_location.items():
+            minutes = sorted(minutes)
+            values = []
+            for t in range(start, end + 1, step):
+                count = bisect.bisect_right(minutes, t) - bisect.bisect_right(
+                    minutes, t - window
+                )
+                if count:
+                    values.append([t, str(count)])
+            if values:
+                result.append({"metric": {"location": location}, "values": values})
+        self.send_json(
+            {"status": "success", "data": {"resultType": "matrix", "result": result}}
+        )
+
+    def get_export(self, path):
+        metric, column = self.source_series(self.query["match[]"][0])
+        start = max(parse_time(self.query["start"][0]), self.server.data_start)
+        end = min(parse_time(self.query["end"][0]), time.time())
+        times = range(int(-(-start // 60) * 60), int(end) + 1, 60)
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/stream+json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for block in range(0, len(times), 8192):
+            block_times = times[block : block + 8192]
+            line = json.dumps(
+                {
+                    "metric": metric,
+                    "values": [synthetic_value(t, column) for t in block_times],
+                    "timestamps": [t * 1000 for t in block_times],
+                }
+            ).encode() + b"\n"
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(line), line))
+            self.server.count("rows_out", len(block_times))
+        self.wfile.write(b"0\r\n\r\n")
+
+    def post_import(self, path):
+        body = self.body
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+
+        series = [json.loads(line) for line in body.splitlines() if line]
+        self.record([(s["metric"], s["timestamps"]) for s in series])
+
+    def post_write(self, path):
+        import snappy
+
+        self.record(decode_write_request(snappy.decompress(self.body)))
+
+    def record(self, series):
+        """Count imported (metric, timestamps) series and note their last times"""
+        rows = 0
+        last_times = {}
+        for metric, timestamps in series:
+            if not timestamps:
+                continue
+            rows += len(timestamps)
+            key = (metric.get("device"), metric.get("location"))
+            last_times[key] = max(last_times.get(key, 0), max(timestamps))
+            if self.server.keep_samples:
+                self.server.keep(metric.get("__name__"), *key, timestamps)
+
+        with self.server.lock:
+            for key, last_time in last_times.items():
+                self.server.last_times[key] = max(
+                    self.server.last_times.get(key, 0), last_time
+                )
+        self.server.count("rows_in", rows)
+        self.send_body(b"", status=204)
+
+
+class AlertmanagerHandler(Handler):
+    """Alertmanager v2 silences and alerts"""
+
+    routes = {
+        "/api/v2/silences": "silences",
+        "/api/v2/silence": "silence",
+        "/api/v2/alerts": "alerts",
+    }
+
+    def get_silences(self, path):
+        with self.server.lock:
+            silences = list(self.server.silences.values())
+        for matcher in self.query.get("filter", []):
+            silences = [s for s in silences if silence_matches(s, matcher)]
+        self.send_json(silences)
+
+    def post_silences(self, path):
+        silence = json.loads(self.body)
+        silence_id = silence.get("id") or str(uuid.uuid4())
+        starts_at = datetime.fromisoformat(silence["startsAt"].replace("Z", "+00:00"))
+        pending = starts_at > datetime.now(timezone.utc)
+        silence.update(
+            {
+                "id": silence_id,
+                "status": {"state": "pending" if pending else "active"},
+                "updatedAt": datetime.now(timezone.utc).isoformat(),
+            }
+        )
+        with self.server.lock:
+            self.server.silences[silence_id] = silence
+        self.send_json({"silenceID": silence_id})
+
+    def get_silence(self, path):
+        with self.server.lock:
+            silence = self.server.silences.get(path.rsplit("/", 1)[1])
+        if silence is None:
+            return self.send_json({"error": "not found"}, status=404)
+        self.send_json(silence)
+
+    def delete_silence(self, path):
+        with self.server.lock:
+            silence = self.server.silences.get(path.rsplit("/", 1)[1])
+            if silence is not None:
+                silence["status"] = {"state": "expired"}
+        if silence is None:
+            return self.send_json({"error": "not found"}, status=404)
+        self.send_body(b"", status=200)
+
+    def get_alerts(self, path):
+        self.send_json(
+            [{"labels": {"alertname": name}} for name in self.server.alert_names]
+        )
+
+
+class VictoriaMetricsStandIn(StandIn):
+    """VictoriaMetrics stand-in that can keep the timestamps it imports"""
+
+    def __init__(self, *args, keep_samples=False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.keep_samples = keep_samples
+        self.last_times = {}
+        # Imported timestamps per (name, device, location), sorted on demand
+        self.kept = {}
+        self.minute_cache = None
+
+    def keep(self, name, device, location, timestamps):
+        with self.lock:
+            self.kept.setdefault((name, device, location), []).append(
+                array("q", timestamps)
+            )
+            self.minute_cache = None
+
+    def minutes(self):
+        """Sorted minutes (unix seconds at the end of each minute) with samples,
+        per series"""
+        samples = self.samples()
+        with self.lock:
+            if self.minute_cache is None:
+                self.minute_cache = {
+                    key: array("q", sorted({-(-t // 60000) * 60 for t in times}))
+                    for key, times in samples.items()
+                }
+            return self.minute_cache
+
+    def samples(self):
+        """Sorted, deduplicated timestamps per series"""
+        with self.lock:
+            for key, parts in self.kept.items():
+                if len(parts) > 1:
+                    merged = set()
+                    for part in parts:
+                        merged.update(part)
+                    self.kept[key] = [array("q", sorted(merged))]
+            return {key: parts[0] for key, parts in self.kept.items()}
+
+    def forget(self, query):
+        start = int(parse_time(query["start"][0])) * 1000
+        end = int(parse_time(query["end"][0])) * 1000
+        location = query.get("location", [None])[0]
+        forgotten = 0
+        for key, times in self.samples().items():
+            if location is not None and key[2] != location:
+                continue
+            low, high = bisect.bisect_left(times, start), bisect.bisect_right(times, end)
+            with self.lock:
+                self.kept[key] = [times[:low] + times[high:]]
+                self.minute_cache = None
+            forgotten += high - low
+        return forgotten
+
+
+def start_stand_ins(
+    days=30, latency=0.0, failure_rate=0.0, alert_names=(), keep_samples=False
+):
+    """Start one stand-in per IoTaWatt unit plus VictoriaMetrics and Alertmanager"""
+    data_start = (time.time() - days * 86400) // 86400 * 86400
+
+    servers = {}
+    for host in ("iwatt5", "iwatt6"):
+        servers[host] = StandIn(IoTaWattHandler, latency=latency, failure_rate=failure_rate)
+        servers[host].data_start = data_start
+
+    servers["victoriametrics"] = VictoriaMetricsStandIn(
+        VictoriaMetricsHandler,
+        latency=latency,
+        failure_rate=failure_rate,
+        keep_samples=keep_samples,
+    )
+    servers["victoriametrics"].data_start = data_start
+
+    servers["alertmanager"] = StandIn(
+        AlertmanagerHandler, latency=latency, failure_rate=failure_rate
+    )
+    servers["alertmanager"].silences = {}
+    servers["alertmanager"].alert_names = list(alert_names)
+
+    for server in servers.values():
+        server.start()
+    return servers, data_start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--days", type=float, default=30, help="days of device history")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds per request")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="share of 503s")
+    parser.add_argument(
+        "--alert", action="append", default=[], help="alert name served by /api/v2/alerts"
+    )
+    parser.add_argument(
+        "--keep-samples", action="store_true", help="keep imported timestamps"
+    )
+    args = parser.parse_args()
+
+    servers, data_start = start_stand_ins(
+        args.days, args.latency, args.failure_rate, args.alert, args.keep_samples
+    )
+    print(
+        json.dumps(
+            {
+                "data_start": data_start,
+                "urls": {name: server.url for name, server in servers.items()},
+            }
+        ),
+        flush=True,
+    )
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
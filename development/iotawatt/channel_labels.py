@@ -0,0 +1,51 @@
+import json
+import os
+
+from remote_write import encode_labels
+from samples import metric_prefix
+
+rules_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "channel_labels.json")
+
+
+## Labels of one channel plus its serialized "metric" prefix for /api/v1/import
+## and its encoded labels for remote write
+class LabelSet:
+    def __init__(self, metric):
+        self.metric = metric
+        self.json_prefix = metric_prefix(metric)
+        self.protobuf_labels = encode_labels(metric)
+
+
+def load_rules(path=rules_path):
+    with open(path) as f:
+        return json.load(f)
+
+
+## Apply every rule whose prefix matches, in order, then fill in the defaults
+def channel_labels(measurement, rules):
+    labels = {}
+    for rule in rules["rules"]:
+        if measurement.startswith(rule["prefix"]):
+            labels.update(rule["labels"])
+    for name, value in rules["defaults"].items():
+        labels.setdefault(name, value)
+    return labels
+
+
+## Compile the rule table once into a LabelSet per (host, measurement)
+def compile_label_sets(measurements_all, rules=None, metric_name="power"):
+    if rules is None:
+        rules = load_rules()
+    return {
+        (host, measurement): LabelSet(
+            {
+                "__name__": metric_name,
+                "location": measurement,
+                "source": "iotawatt",
+                "device": host,
+                **channel_labels(measurement, rules),
+            }
+        )
+        for host, measurements in measurements_all.items()
+        for measurement in measurements
+    }
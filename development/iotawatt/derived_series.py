@@ -0,0 +1,44 @@
+from array import array
+from bisect import bisect_left
+
+from samples import to_millis
+
+# Channels the derived series are computed from, in the order derive() takes them
+inputs = ["Mains_1", "Mains_2", "SolarA_1", "SolarA_2", "SolarB_1", "SolarB_2"]
+# Derived series, in the order derive() returns them
+names = ["Load", "Solar", "GridImport", "GridExport"]
+# Labels of the derived series, they are their own metric so sums over power
+# don't count the same watts twice
+metric_name = "power_derived"
+rules = {"rules": [], "defaults": {"type": "Derived"}}
+
+
+## Load = Mains_1 + Mains_2
+## Solar = max(0, SolarA + SolarB)
+## Grid Import = max(0, Load - Solar)
+## Grid Export = max(0, Solar - Load)
+def derive(mains_1, mains_2, solar_a_1, solar_a_2, solar_b_1, solar_b_2):
+    load = mains_1 + mains_2
+    solar = max(0, solar_a_1 + solar_a_2 + solar_b_1 + solar_b_2)
+    return load, solar, max(0, load - solar), max(0, solar - load)
+
+
+## Derived series from rows [time, *inputs] that share timestamps, as
+## (name, timestamps, values) for each name in starts. Rows before that name's
+## start time and rows with a missing input are dropped.
+def derive_rows(rows, starts):
+    rows = [row for row in rows if None not in row]
+    if not rows:
+        return []
+
+    times = [row[0] for row in rows]
+    timestamps = to_millis(times)
+    columns = list(zip(*(derive(*row[1:]) for row in rows)))
+    series = []
+    for name, column in zip(names, columns):
+        if name not in starts:
+            continue
+        first = bisect_left(times, starts[name])
+        if first < len(times):
+            series.append((name, timestamps[first:], array("d", column[first:])))
+    return series
@@ -0,0 +1,59 @@
+import threading
+import time
+
+
+## Adapts the IoTaWatt page size (limit) and the gap between requests to one
+## device so its /query response time stays near target_latency. Pages grow
+## while the device answers quickly, shrink when it slows down, and both halve
+## the page and double the gap when the device errors or reports it is busy.
+class DeviceGovernor:
+    def __init__(
+        self,
+        target_latency=2.0,
+        limit=5000,
+        min_limit=250,
+        max_limit=20000,
+        max_gap=30.0,
+    ):
+        self.lock = threading.Lock()
+        self.target_latency = target_latency
+        self.limit = limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.max_gap = max_gap
+        self.gap = 0.0
+        self.latency = None
+        self.next_request = 0.0
+
+    ## Wait for this request's slot and return the row limit to ask for
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_request)
+            self.next_request = start + self.gap
+            limit = int(self.limit)
+        if start > now:
+            time.sleep(start - now)
+        return limit
+
+    ## Feed back how the request went
+    def record(self, seconds, rows, limit, ok=True):
+        with self.lock:
+            if not ok:
+                self.limit = max(self.min_limit, self.limit / 2)
+                self.gap = min(self.max_gap, max(1.0, self.gap * 2))
+                return
+
+            if self.latency is None:
+                self.latency = seconds
+            else:
+                self.latency = 0.7 * self.latency + 0.3 * seconds
+
+            if self.latency > self.target_latency * 1.2:
+                self.limit = max(self.min_limit, self.limit * 0.75)
+                self.gap = min(self.max_gap, self.gap + 0.5)
+            elif self.latency < self.target_latency * 0.8:
+                # Only a full page says anything about how big a page can be
+                if rows >= limit:
+                    self.limit = min(self.max_limit, self.limit * 1.25)
+                self.gap = max(0.0, self.gap - 0.5)
@@ -0,0 +1,36 @@
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+## requests.Session that applies a default timeout to every request
+class TimeoutSession(requests.Session):
+    def __init__(self, timeout):
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return super().request(method, url, **kwargs)
+
+
+## Pooled keep-alive session for one endpoint, with timeouts and retries with backoff.
+## Only idempotent methods are retried after a request was sent, POSTs are retried
+## on connection errors only.
+def make_session(pool_size=4, timeout=(5, 60), retries=3, backoff=0.5):
+    session = TimeoutSession(timeout)
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff,
+        status_forcelist=(429, 500, 502, 503, 504),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=pool_size,
+        pool_block=True,
+        max_retries=retry,
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
@@ -0,0 +1,91 @@
+from array import array
+import sys
+
+try:
+    import snappy
+except ImportError:
+    snappy = None
+
+# Millisecond timestamps from 1971 to 2109 are 6 byte varints, so every sample
+# of a series encodes to the same 18 bytes and a whole series is built at once
+FAST_MIN = 1 << 35
+FAST_MAX = 1 << 42
+SAMPLE_BYTES = 18
+
+
+def varint(n):
+    out = bytearray()
+    while n > 0x7F:
+        out.append(n & 0x7F | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+## One length-delimited protobuf field
+def field(number, payload):
+    return varint(number << 3 | 2) + varint(len(payload)) + payload
+
+
+## The repeated Label fields of a TimeSeries, sorted by name as remote write expects
+def encode_labels(metric):
+    return b"".join(
+        field(1, field(1, name.encode()) + field(2, str(value).encode()))
+        for name, value in sorted(metric.items())
+    )
+
+
+## The repeated Sample fields of a TimeSeries, each
+## 0x12 0x10 | 0x09 <double value> | 0x10 <6 byte varint timestamp>
+def encode_samples(timestamps, values):
+    count = len(timestamps)
+    if not count:
+        return b""
+    if min(timestamps) < FAST_MIN or max(timestamps) >= FAST_MAX:
+        return b"".join(
+            field(2, b"\x09" + array("d", [v]).tobytes() + b"\x10" + varint(t))
+            for t, v in zip(timestamps, values)
+        )
+
+    timestamps = array("q", timestamps)
+    values = array("d", values)
+    if sys.byteorder == "big":
+        timestamps.byteswap()
+        values.byteswap()
+
+    # Spread the 7 bit groups of every 8 byte timestamp slot one byte apart at
+    # once, on the whole series as one integer, and set the continuation bits
+    packed = int.from_bytes(timestamps.tobytes(), "little")
+    spread = int.from_bytes(b"\x80\x80\x80\x80\x80\x00\x00\x00" * count, "little")
+    for group in range(6):
+        mask = (0x7F << 7 * group).to_bytes(8, "little") * count
+        spread |= (packed & int.from_bytes(mask, "little")) << group
+    varints = spread.to_bytes(8 * count, "little")
+    doubles = values.tobytes()
+
+    out = bytearray(SAMPLE_BYTES * count)
+    out[0::SAMPLE_BYTES] = b"\x12" * count
+    out[1::SAMPLE_BYTES] = b"\x10" * count
+    out[2::SAMPLE_BYTES] = b"\x09" * count
+    for byte in range(8):
+        out[3 + byte :: SAMPLE_BYTES] = doubles[byte::8]
+    out[11::SAMPLE_BYTES] = b"\x10" * count
+    for byte in range(6):
+        out[12 + byte :: SAMPLE_BYTES] = varints[byte::8]
+    return bytes(out)
+
+
+## One TimeSeries of a WriteRequest, metric is a dict or a LabelSet carrying
+## its encoded labels
+def encode_series(metric, timestamps, values):
+    labels = getattr(metric, "protobuf_labels", None)
+    if labels is None:
+        labels = encode_labels(getattr(metric, "metric", metric))
+    return field(1, labels + encode_samples(timestamps, values))
+
+
+## Snappy compressed WriteRequest of encoded series
+def encode_request(series):
+    if snappy is None:
+        raise RuntimeError("python-snappy is needed for remote write")
+    return snappy.compress(b"".join(series))
@@ -0,0 +1,187 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import repeat
+import operator
+import threading
+
+from channel_labels import LabelSet
+import derived_series
+
+# Rollup resolutions, buckets are aligned to UTC
+resolutions = {"1h": 3600, "1d": 86400}
+# A sample's power is held until the next sample, but for no longer than this
+max_gap = 300
+metric_name = "energy_wh"
+# Rollups of the derived series, their own metric like the power they come from
+derived_metric_name = "energy_derived_wh"
+
+
+## Key a rollup series is spooled, imported and labelled under
+def rollup_key(measurement, resolution):
+    return f"{measurement}:{resolution}"
+
+
+## Series a key belongs to, the measurement itself or the one it rolls up
+def source_series(key):
+    return key.partition(":")[0]
+
+
+def is_rollup_key(key):
+    return ":" in key
+
+
+## An energy_wh (energy_derived_wh for derived series) LabelSet per
+## (host, rollup key), from the power label sets
+def compile_rollup_label_sets(label_sets):
+    return {
+        (host, rollup_key(measurement, resolution)): LabelSet(
+            {
+                **label_set.metric,
+                "__name__": (
+                    derived_metric_name
+                    if label_set.metric["__name__"] == derived_series.metric_name
+                    else metric_name
+                ),
+                "resolution": resolution,
+            }
+        )
+        for (host, measurement), label_set in label_sets.items()
+        for resolution in resolutions
+    }
+
+
+## Integrator state of one series: the last sample and the open bucket per
+## resolution as [bucket_start, wh, whole]. A bucket is only whole if the
+## integrator saw it from its start.
+class RollupState:
+    def __init__(self, last_time, last_value, buckets):
+        self.last_time = last_time
+        self.last_value = last_value
+        self.buckets = buckets
+
+    ## State for a series known to start at start (unix seconds), so the
+    ## buckets beginning there are whole
+    @classmethod
+    def starting_at(cls, start):
+        return cls(
+            None,
+            None,
+            {
+                name: [start // size * size, 0.0, start % size == 0]
+                for name, size in resolutions.items()
+            },
+        )
+
+    def copy(self):
+        return RollupState(
+            self.last_time,
+            self.last_value,
+            {name: list(bucket) for name, bucket in self.buckets.items()},
+        )
+
+
+## Feed samples (timestamps in ms) through an integrator state. Returns the new
+## state and the closed buckets per resolution as (timestamps, wh) arrays.
+## Samples at or before the state's last time were already counted and are skipped.
+def integrate(state, timestamps, values):
+    state = state.copy() if state is not None else RollupState(None, None, {})
+    if state.last_time is not None:
+        first = bisect_right(timestamps, state.last_time * 1000)
+        timestamps, values = timestamps[first:], values[first:]
+    if not timestamps:
+        return state, {}
+
+    times = [timestamp // 1000 for timestamp in timestamps]
+    values = list(values)
+    if state.last_time is not None:
+        times.insert(0, state.last_time)
+        values.insert(0, state.last_value)
+    # Watt-seconds of every sample but the last, held until the next sample
+    spans = map(min, map(operator.sub, times[1:], times), repeat(max_gap))
+    energy = list(map(operator.mul, values, spans))
+
+    closed = {}
+    for name, size in resolutions.items():
+        bucket = state.buckets.get(name)
+        if bucket is None:
+            # First sample of a new series, the bucket it lands in is partial
+            bucket = [times[0] // size * size, 0.0, times[0] % size == 0]
+        position = 0
+        while True:
+            end = bisect_left(times, bucket[0] + size, position)
+            bucket[1] += sum(energy[position:end]) / 3600
+            if end == len(times):
+                break
+            # Nothing was counted in it if the series only started after it
+            if bucket[2] and end > 0:
+                closed.setdefault(name, []).append((bucket[0], bucket[1]))
+            bucket = [times[end] // size * size, 0.0, True]
+            position = end
+        state.buckets[name] = bucket
+
+    state.last_time = times[-1]
+    state.last_value = values[-1]
+    return state, _as_arrays(closed)
+
+
+## Count the last sample up to end and close every bucket that ends by then
+def finish(state, end):
+    state = state.copy()
+    closed = {}
+    if state.last_time is not None:
+        wh = state.last_value * min(end - state.last_time, max_gap) / 3600
+        for name, bucket in state.buckets.items():
+            bucket[1] += wh
+            if bucket[2] and bucket[0] + resolutions[name] <= end:
+                closed[name] = [(bucket[0], bucket[1])]
+    state.last_time = None
+    return state, _as_arrays(closed)
+
+
+def _as_arrays(closed):
+    return {
+        name: (
+            array("q", [bucket_start * 1000 for bucket_start, _ in buckets]),
+            array("d", [wh for _, wh in buckets]),
+        )
+        for name, buckets in closed.items()
+    }
+
+
+## Rollup integrator state per (host, series) for the sync, checkpointed in SyncState
+class Rollups:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.states = {}
+        self.store = None
+
+    ## Checkpoint to a store and resume from what it holds
+    def attach(self, store):
+        self.store = store
+        with self.lock:
+            self.states.update(store.get_rollups())
+
+    ## Last sample time counted for a series, None if it has no state yet
+    def resume_time(self, host, series):
+        with self.lock:
+            state = self.states.get((host, series))
+        return state.last_time if state is not None else None
+
+    ## Run samples through a series' integrator without keeping the result yet.
+    ## Returns the new state and the closed buckets as (rollup key, timestamps, wh).
+    def feed(self, host, series, timestamps, values):
+        with self.lock:
+            state = self.states.get((host, series))
+        state, closed = integrate(state, timestamps, values)
+        return state, [
+            (rollup_key(series, name), bucket_times, wh)
+            for name, (bucket_times, wh) in closed.items()
+        ]
+
+    ## Keep new states, once what they produced is safely spooled
+    def commit(self, host, states):
+        with self.lock:
+            for series, state in states.items():
+                self.states[(host, series)] = state
+        if self.store is not None:
+            self.store.set_rollups(host, states)
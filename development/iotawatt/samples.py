@@ -0,0 +1,159 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import compress, repeat
+import json
+import operator
+import re
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+## Parse a response body once, with orjson when it is installed
+if orjson is not None:
+    json_loads = orjson.loads
+
+    def json_dumps(obj):
+        return orjson.dumps(obj)
+
+else:
+    json_loads = json.loads
+
+    def json_dumps(obj):
+        return json.dumps(obj).encode()
+
+
+DATA_KEY = re.compile(rb'"data"\s*:\s*\[')
+DATA_END = re.compile(rb"\]\s*\]")
+
+
+## Parse an IoTaWatt /query response as it arrives from the socket. Iterating
+## yields the "data" rows in lists of about batch_bytes of JSON each, so only one
+## batch is held in memory at a time. Once the response is done, fields holds
+## everything else in it ("range", "labels", "limit") and rows the row count.
+class QueryStream:
+    def __init__(self, chunks, batch_bytes=1024 * 1024):
+        self.chunks = chunks
+        self.batch_bytes = batch_bytes
+        self.fields = None
+        self.rows = 0
+
+    def __iter__(self):
+        chunks = iter(self.chunks)
+        head = bytearray()
+        for chunk in chunks:
+            head += chunk
+            match = DATA_KEY.search(head)
+            if match is not None:
+                buffer = head[match.end() :]
+                del head[match.end() - 1 :]
+                break
+        else:
+            self.fields = json_loads(bytes(head))
+            return
+
+        # Rows are flat arrays, the "]" that closes the last row is followed by
+        # the one closing "data"
+        tail = None
+        while tail is None:
+            buffer = buffer.lstrip(b", \t\r\n")
+            if buffer.startswith(b"]"):
+                tail = buffer[1:]
+                break
+            end = DATA_END.search(buffer)
+            if end is not None:
+                tail = buffer[end.end() :]
+                last = end.start()
+            elif len(buffer) >= self.batch_bytes and b"]" in buffer:
+                last = buffer.rfind(b"]")
+            else:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    raise ValueError("IoTaWatt response ended inside data")
+                buffer += chunk
+                continue
+            rows = json_loads(b"[" + buffer[: last + 1] + b"]")
+            del buffer[: last + 1]
+            self.rows += len(rows)
+            yield rows
+
+        for chunk in chunks:
+            tail += chunk
+        self.fields = json_loads(bytes(head + b"[]" + tail))
+
+
+## Unix seconds to the int64 milliseconds /api/v1/import expects
+def to_millis(times):
+    return array("q", map(int, map(operator.mul, times, repeat(1000))))
+
+
+## [[time, value], ...] rows (IoTaWatt or query_range) to typed timestamp/value arrays
+def rows_to_arrays(rows):
+    if not rows:
+        return array("q"), array("d")
+    times, values = zip(*rows)
+    return to_millis(times), array("d", map(float, values))
+
+
+## Split multi-column [time, v1, v2, ...] rows into (timestamps, values) per column,
+## dropping rows before that column's start time and rows where it is missing
+def split_rows(rows, starts):
+    if not rows:
+        return [(array("q"), array("d")) for _ in starts]
+
+    times, *columns = zip(*rows)
+    timestamps = to_millis(times)
+    series = []
+    for column, start in zip(columns, starts):
+        first = bisect_left(times, start)
+        column_timestamps = timestamps[first:]
+        column = column[first:]
+        if None in column:
+            keep = list(map(operator.is_not, column, repeat(None)))
+            column_timestamps = array("q", compress(column_timestamps, keep))
+            column = compress(column, keep)
+        series.append((column_timestamps, array("d", column)))
+    return series
+
+
+## The part of a series at or after start (unix seconds)
+def since(timestamps, values, start):
+    first = bisect_left(timestamps, start * 1000)
+    return timestamps[first:], values[first:]
+
+
+## The parts of a series inside sorted [(first, last)] ranges (unix seconds, inclusive)
+def within(timestamps, values, ranges):
+    kept_timestamps, kept_values = array("q"), array("d")
+    for first, last in ranges:
+        low = bisect_left(timestamps, first * 1000)
+        high = bisect_right(timestamps, last * 1000)
+        kept_timestamps += timestamps[low:high]
+        kept_values += values[low:high]
+    return kept_timestamps, kept_values
+
+
+def as_list(samples):
+    return samples.tolist() if isinstance(samples, array) else samples
+
+
+## Serialized start of an import line, everything up to the values
+def metric_prefix(metric):
+    return b'{"metric":' + json_dumps(metric) + b',"values":'
+
+
+## One /api/v1/import JSON line for a series, metric is a dict or a LabelSet
+## carrying its cached prefix
+def encode_series(metric, timestamps, values):
+    prefix = getattr(metric, "json_prefix", None)
+    if prefix is None:
+        prefix = metric_prefix(metric)
+    return (
+        prefix
+        + json_dumps(as_list(values))
+        + b',"timestamps":'
+        + json_dumps(as_list(timestamps))
+        + b"}"
+    )
@@ -0,0 +1,205 @@
+from array import array
+import glob
+import os
+import struct
+import threading
+import zlib
+
+# Record header: payload length, payload crc32, host length, measurement length, samples
+header = struct.Struct("<IIHHI")
+ack_entry = struct.Struct("<I")
+
+
+## Write-ahead spool of fetched series waiting for import. Records are appended
+## to segment files before they are handed to the import writer and acked once
+## VictoriaMetrics accepts them; segments are deleted when every record is acked.
+class Spool:
+    def __init__(self, directory, segment_bytes=16 * 1024 * 1024):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.lock = threading.Lock()
+        # (segment, index) -> (offset, host, measurement, last_time)
+        self.pending = {}
+        self.inflight = set()
+        self.counts = {}
+        self.segment = 0
+        self.index = 0
+        self.file = None
+        self.acks = None
+
+        for path in sorted(glob.glob(os.path.join(directory, "*.seg"))):
+            self._load(int(os.path.basename(path)[:-4]))
+        self._open(self.segment + 1)
+
+    def _path(self, segment, suffix):
+        return os.path.join(self.directory, f"{segment:08d}.{suffix}")
+
+    ## Index the unacked records of a segment left by a previous run
+    def _load(self, segment):
+        acked = set()
+        if os.path.exists(self._path(segment, "ack")):
+            with open(self._path(segment, "ack"), "rb") as f:
+                data = f.read()
+            usable = len(data) - len(data) % ack_entry.size
+            acked = {i for (i,) in ack_entry.iter_unpack(data[:usable])}
+
+        self.segment = max(self.segment, segment)
+        count = 0
+        with open(self._path(segment, "seg"), "rb") as f:
+            index = 0
+            while True:
+                offset = f.tell()
+                record = self._read(f)
+                if record is None:
+                    break
+                if index not in acked:
+                    host, measurement, timestamps, _ = record
+                    self.pending[(segment, index)] = (
+                        offset,
+                        host,
+                        measurement,
+                        timestamps[-1] // 1000,
+                    )
+                    count += 1
+                index += 1
+
+        if count:
+            self.counts[segment] = count
+        else:
+            self._delete(segment)
+
+    def _open(self, segment):
+        self.segment = segment
+        self.index = 0
+        self.file = open(self._path(segment, "seg"), "ab")
+        self.acks = open(self._path(segment, "ack"), "ab")
+
+    def _read(self, f):
+        head = f.read(header.size)
+        if len(head) < header.size:
+            return None
+        length, crc, host_length, measurement_length, samples = header.unpack(head)
+        payload = f.read(length)
+        # A torn write at the end of a segment from a crash
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            return None
+
+        host = payload[:host_length].decode()
+        position = host_length
+        measurement = payload[position : position + measurement_length].decode()
+        position += measurement_length
+        timestamps = array("q")
+        timestamps.frombytes(payload[position : position + samples * 8])
+        values = array("d")
+        values.frombytes(payload[position + samples * 8 :])
+        return host, measurement, timestamps, values
+
+    def _delete(self, segment):
+        for suffix in ("seg", "ack"):
+            if os.path.exists(self._path(segment, suffix)):
+                os.remove(self._path(segment, suffix))
+        self.counts.pop(segment, None)
+
+    ## Durably append [(host, measurement, timestamps, values), ...] with one
+    ## fsync and return a record id for each
+    def append(self, records):
+        with self.lock:
+            ids = []
+            for host, measurement, timestamps, values in records:
+                host_bytes = host.encode()
+                measurement_bytes = measurement.encode()
+                payload = (
+                    host_bytes
+                    + measurement_bytes
+                    + array("q", timestamps).tobytes()
+                    + array("d", values).tobytes()
+                )
+                record_id = (self.segment, self.index)
+                self.pending[record_id] = (
+                    self.file.tell(),
+                    host,
+                    measurement,
+                    timestamps[-1] // 1000,
+                )
+                self.inflight.add(record_id)
+                self.file.write(
+                    header.pack(
+                        len(payload),
+                        zlib.crc32(payload),
+                        len(host_bytes),
+                        len(measurement_bytes),
+                        len(timestamps),
+                    )
+                    + payload
+                )
+                self.counts[self.segment] = self.counts.get(self.segment, 0) + 1
+                self.index += 1
+                ids.append(record_id)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+            if self.file.tell() >= self.segment_bytes:
+                self.file.close()
+                self.acks.close()
+                if self.counts[self.segment] == 0:
+                    self._delete(self.segment)
+                self._open(self.segment + 1)
+            return ids
+
+    ## The record was imported
+    def ack(self, record_id):
+        segment, index = record_id
+        with self.lock:
+            if self.pending.pop(record_id, None) is None:
+                return
+            self.inflight.discard(record_id)
+            self.counts[segment] -= 1
+
+            if segment == self.segment:
+                self.acks.write(ack_entry.pack(index))
+                self.acks.flush()
+            elif self.counts[segment] == 0:
+                self._delete(segment)
+            else:
+                with open(self._path(segment, "ack"), "ab") as f:
+                    f.write(ack_entry.pack(index))
+
+    ## The import holding the record failed, it will be replayed
+    def release(self, record_id):
+        with self.lock:
+            self.inflight.discard(record_id)
+
+    ## Claim every pending record not already on its way to VictoriaMetrics
+    def replay(self):
+        with self.lock:
+            self.file.flush()
+            claimed = sorted(set(self.pending) - self.inflight)
+            self.inflight.update(claimed)
+            locations = [(record_id, self.pending[record_id][0]) for record_id in claimed]
+
+        records = []
+        f = None
+        for record_id, offset in locations:
+            if f is None or f.name != self._path(record_id[0], "seg"):
+                if f is not None:
+                    f.close()
+                f = open(self._path(record_id[0], "seg"), "rb")
+            f.seek(offset)
+            records.append((record_id, *self._read(f)))
+        if f is not None:
+            f.close()
+        return records
+
+    ## Newest spooled time per (host, measurement), imported or not
+    def last_times(self):
+        with self.lock:
+            last_times = {}
+            for _, host, measurement, last_time in self.pending.values():
+                key = (host, measurement)
+                last_times[key] = max(last_times.get(key, last_time), last_time)
+            return last_times
+
+    def size(self):
+        with self.lock:
+            return len(self.pending)
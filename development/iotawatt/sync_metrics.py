@@ -0,0 +1,70 @@
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+device_query_seconds = Histogram(
+    "iotawatt_sync_device_query_seconds",
+    "Latency of IoTaWatt /query requests",
+    ["device"],
+    buckets=(0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60, 120),
+)
+device_page_limit = Gauge(
+    "iotawatt_sync_device_page_limit",
+    "Rows per IoTaWatt /query page chosen by the governor",
+    ["device"],
+)
+device_request_gap = Gauge(
+    "iotawatt_sync_device_request_gap_seconds",
+    "Pause between IoTaWatt /query requests chosen by the governor",
+    ["device"],
+)
+vm_import_seconds = Histogram(
+    "iotawatt_sync_vm_import_seconds",
+    "Latency of VictoriaMetrics write requests (/api/v1/import or /api/v1/write)",
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30),
+)
+resume_lookup_seconds = Histogram(
+    "iotawatt_sync_resume_lookup_seconds",
+    "Latency of the VictoriaMetrics resume point lookup",
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30),
+)
+vm_import_bytes = Counter(
+    "iotawatt_sync_vm_import_bytes_total",
+    "Compressed bytes POSTed to /api/v1/import or /api/v1/write",
+)
+rows_ingested = Counter(
+    "iotawatt_sync_rows_ingested_total",
+    "Samples accepted by VictoriaMetrics",
+    ["device", "channel"],
+)
+bytes_sent = Counter(
+    "iotawatt_sync_bytes_sent_total",
+    "Encoded bytes queued for VictoriaMetrics, JSON lines or protobuf",
+    ["device", "channel"],
+)
+errors = Counter(
+    "iotawatt_sync_errors_total",
+    "Failed device queries and imports",
+    ["device", "channel", "stage"],
+)
+ingestion_lag = Gauge(
+    "iotawatt_sync_lag_seconds",
+    "Seconds between now and the last imported sample",
+    ["device", "channel"],
+)
+spool_records = Gauge(
+    "iotawatt_sync_spool_records",
+    "Spooled series not yet accepted by VictoriaMetrics",
+)
+pass_duration = Gauge(
+    "iotawatt_sync_pass_duration_seconds",
+    "Duration of the last sync pass",
+)
+
+
+## Hook for the import writers (on_send=...)
+def observe_import(seconds, body_bytes, ok):
+    vm_import_seconds.observe(seconds)
+    vm_import_bytes.inc(body_bytes)
+
+
+def start_metrics_server(port):
+    start_http_server(port)
@@ -0,0 +1,116 @@
+import json
+import sqlite3
+import threading
+
+from rollups import RollupState
+
+
+## Durable sync progress kept in a small SQLite file next to the scripts
+class SyncState:
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS watermarks (
+                host TEXT NOT NULL,
+                measurement TEXT NOT NULL,
+                last_time INTEGER NOT NULL,
+                PRIMARY KEY (host, measurement)
+            )"""
+        )
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS backfill_chunks (
+                host TEXT NOT NULL,
+                measurement TEXT NOT NULL,
+                chunk_start INTEGER NOT NULL,
+                chunk_end INTEGER NOT NULL,
+                rows INTEGER NOT NULL,
+                PRIMARY KEY (host, measurement, chunk_start)
+            )"""
+        )
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS rollups (
+                host TEXT NOT NULL,
+                series TEXT NOT NULL,
+                last_time INTEGER,
+                last_value REAL,
+                buckets TEXT NOT NULL,
+                PRIMARY KEY (host, series)
+            )"""
+        )
+        self.db.commit()
+
+    ## Last committed timestamp for every (host, measurement)
+    def get_watermarks(self):
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT host, measurement, last_time FROM watermarks"
+            ).fetchall()
+        return {(host, measurement): last_time for host, measurement, last_time in rows}
+
+    ## Record a committed timestamp, never moving a watermark backwards
+    def set_watermark(self, host, measurement, last_time):
+        with self.lock:
+            self.db.execute(
+                """INSERT INTO watermarks (host, measurement, last_time)
+                VALUES (?, ?, ?)
+                ON CONFLICT (host, measurement)
+                DO UPDATE SET last_time = max(last_time, excluded.last_time)""",
+                (host, measurement, last_time),
+            )
+            self.db.commit()
+
+    ## Backfill chunks already imported, as (host, measurement, chunk_start, chunk_end)
+    def get_done_chunks(self):
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT host, measurement, chunk_start, chunk_end FROM backfill_chunks"
+            ).fetchall()
+        return set(rows)
+
+    def mark_chunk_done(self, host, measurement, chunk_start, chunk_end, rows):
+        with self.lock:
+            self.db.execute(
+                """INSERT OR REPLACE INTO backfill_chunks
+                (host, measurement, chunk_start, chunk_end, rows)
+                VALUES (?, ?, ?, ?, ?)""",
+                (host, measurement, int(chunk_start), int(chunk_end), rows),
+            )
+            self.db.commit()
+
+    ## Rollup integrator state for every (host, series)
+    def get_rollups(self):
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT host, series, last_time, last_value, buckets FROM rollups"
+            ).fetchall()
+        return {
+            (host, series): RollupState(last_time, last_value, json.loads(buckets))
+            for host, series, last_time, last_value, buckets in rows
+        }
+
+    ## Record the integrator state of several series of a host in one transaction
+    def set_rollups(self, host, states):
+        with self.lock:
+            self.db.executemany(
+                """INSERT OR REPLACE INTO rollups
+                (host, series, last_time, last_value, buckets)
+                VALUES (?, ?, ?, ?, ?)""",
+                [
+                    (
+                        host,
+                        series,
+                        state.last_time,
+                        state.last_value,
+                        json.dumps(state.buckets),
+                    )
+                    for series, state in states.items()
+                ],
+            )
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,146 @@
+import gzip
+import logging
+import threading
+import time
+
+import requests
+
+from http_client import make_session
+import remote_write
+from samples import encode_series
+
+logger = logging.getLogger(__name__)
+
+
+## Batches encoded series into bodies for one VictoriaMetrics write endpoint.
+## Subclasses set the path and how series and bodies are encoded.
+class BatchWriter:
+    path = None
+
+    def __init__(
+        self, server, max_bytes=4 * 1024 * 1024, max_age=10, session=None, on_send=None
+    ):
+        self.url = f"{server}{self.path}"
+        self.session = session if session is not None else make_session()
+        # Called as on_send(seconds, body_bytes, ok) after every POST
+        self.on_send = on_send
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.lines = []
+        self.callbacks = []
+        self.size = 0
+        self.started = None
+
+    ## Queue one series and return its encoded size. on_commit is called once
+    ## VictoriaMetrics accepts it, on_error if the batch holding it fails.
+    def add(self, metric, timestamps, values, on_commit=None, on_error=None):
+        line = self.encode(metric, timestamps, values)
+
+        with self.lock:
+            if not self.lines:
+                self.started = time.monotonic()
+            self.lines.append(line)
+            self.size += len(line) + 1
+            if on_commit is not None or on_error is not None:
+                self.callbacks.append((on_commit, on_error))
+            if (
+                self.size >= self.max_bytes
+                or time.monotonic() - self.started >= self.max_age
+            ):
+                batch = self._take()
+            else:
+                batch = None
+
+        if batch:
+            self._send(*batch)
+        return len(line)
+
+    ## Send whatever is queued
+    def flush(self):
+        with self.lock:
+            batch = self._take()
+        if batch:
+            return self._send(*batch)
+        return True
+
+    def _take(self):
+        if not self.lines:
+            return None
+        batch = (self.lines, self.callbacks)
+        self.lines = []
+        self.callbacks = []
+        self.size = 0
+        return batch
+
+    def _send(self, lines, callbacks):
+        body = self.body(lines)
+        started = time.monotonic()
+        try:
+            write_response = self.session.post(
+                self.url, data=body, headers=self.headers
+            )
+            write_response.raise_for_status()
+
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Error during API request: {e}")
+            self._sent(started, body, False)
+            for _, on_error in callbacks:
+                if on_error is not None:
+                    on_error()
+            return False
+
+        self._sent(started, body, True)
+        for on_commit, _ in callbacks:
+            if on_commit is not None:
+                on_commit()
+        return True
+
+    def _sent(self, started, body, ok):
+        if self.on_send is not None:
+            self.on_send(time.monotonic() - started, len(body), ok)
+
+
+## Batches series into gzipped JSON lines bodies for /api/v1/import
+class VMImportWriter(BatchWriter):
+    path = "/api/v1/import"
+    headers = {"Content-Type": "application/json", "Content-Encoding": "gzip"}
+
+    def encode(self, metric, timestamps, values):
+        return encode_series(metric, timestamps, values)
+
+    def body(self, lines):
+        return gzip.compress(b"\n".join(lines) + b"\n", compresslevel=6)
+
+
+## Batches series into snappy compressed Prometheus remote write requests for
+## /api/v1/write. Samples go over as binary doubles and varints instead of text.
+class RemoteWriteWriter(BatchWriter):
+    path = "/api/v1/write"
+    headers = {
+        "Content-Type": "application/x-protobuf",
+        "Content-Encoding": "snappy",
+        "X-Prometheus-Remote-Write-Version": "0.1.0",
+    }
+
+    def __init__(self, server, **kwargs):
+        if remote_write.snappy is None:
+            raise RuntimeError("python-snappy is needed for remote write")
+        super().__init__(server, **kwargs)
+
+    def encode(self, metric, timestamps, values):
+        return remote_write.encode_series(metric, timestamps, values)
+
+    def body(self, lines):
+        return remote_write.encode_request(lines)
+
+
+# Output backends by name
+writers = {"import": VMImportWriter, "remote_write": RemoteWriteWriter}
+
+
+## Writer for the configured output backend, "import" or "remote_write"
+def make_writer(server, backend="import", **kwargs):
+    if backend not in writers:
+        raise ValueError(f"Output backend must be one of {', '.join(writers)}")
+    return writers[backend](server, **kwargs)
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+
+from datetime import datetime, timezone
+import logging
+import os
+import sys
+import time
+
+import requests
+
+import derived_series
+from samples import QueryStream, json_loads, split_rows, within
+import vm_iotawatt_sync as sync
+
+logger = logging.getLogger(__name__)
+
+# Days of history checked, 0 checks everything since each device's default_start.
+# Only whole UTC days are checked, today is left to the sync.
+repair_days = int(os.environ.get("IOTAWATT_REPAIR_DAYS", "0"))
+# Only log the gaps, nothing is fetched or written
+dry_run = os.environ.get("IOTAWATT_REPAIR_DRY_RUN", "") not in ("", "0")
+# Minutes with data are counted in windows of these sizes, coarse to fine. A window
+# with fewer minutes than it spans is counted again at the next size, one without
+# any is missing as a whole. A minute with at least one sample counts, whatever
+# the channel's resolution.
+steps = [86400, 3600, 60]
+# Points per query_range request
+max_points = 10000
+# Missing ranges on a device this close (seconds) are fetched in one query
+merge_window = sync.group_window
+selector = '{__name__=~"power|power_derived",source="iotawatt"}'
+
+
+## Merge sorted (start, end] windows that touch into spans
+def merge_spans(windows):
+    spans = []
+    for start, end in sorted(set(windows)):
+        if spans and start <= spans[-1][1]:
+            spans[-1][1] = max(spans[-1][1], end)
+        else:
+            spans.append([start, end])
+    return spans
+
+
+## Minutes with samples per (device, location) and window end, for the step long
+## windows tiling each (start, end] span. Windows without samples are left out.
+## A minute counts once per location, whether the series has a device label or not.
+def vm_count_windows(spans, step):
+    counts = {}
+    for span_start, span_end in spans:
+        for start in range(span_start, span_end, max_points * step):
+            params = {
+                "query": (
+                    "count_over_time((max(present_over_time("
+                    f"{selector}[1m])) by (location))[{step}s:1m])"
+                ),
+                "start": start + step,
+                "end": min(start + max_points * step, span_end),
+                "step": f"{step}s",
+            }
+            response = sync.vm_session.get(
+                f"{sync.victoriametrics_server}/api/v1/query_range", params=params
+            )
+            if response.status_code != 200:
+                raise Exception(f"Error counting samples: {response.text}")
+
+            for result in json_loads(response.content)["data"]["result"]:
+                location = result["metric"].get("location")
+                if location not in sync.channel_hosts:
+                    continue
+                key = (sync.channel_hosts[location], location)
+                channel = counts.setdefault(key, {})
+                for t, count in result["values"]:
+                    channel[int(t)] = int(float(count))
+    return counts
+
+
+## Missing minutes per (device, location) as sorted [(first, last)] unix second
+## ranges in (start, end]. Every channel is counted per day over the whole range,
+## and only days and then hours that come up short are counted in more detail,
+## so the queries grow with the number of gaps rather than the history.
+## A channel is checked from its first day with samples up to last_times, and
+## the samples missing that day before its first one aren't a gap.
+def find_gaps(start, end, last_times):
+    found = {key: [] for key in last_times}
+    first_window = {}
+    windows = {key: [(start, end)] for key in last_times}
+    for level, step in enumerate(steps):
+        spans = merge_spans(w for key_windows in windows.values() for w in key_windows)
+        counts = vm_count_windows(spans, step) if spans else {}
+        short = {}
+        for key, key_windows in windows.items():
+            channel = counts.get(key, {})
+            if level == 0:
+                if not channel:
+                    continue
+                first_window[key] = min(channel) - step
+                key_windows = [(first_window[key], end)]
+            for window_start, window_end in key_windows:
+                for t in range(window_start + step, window_end + 1, step):
+                    count = channel.get(t, 0)
+                    if count == 0:
+                        found[key].append((t - step + 1, t))
+                    elif count < step // 60:
+                        short.setdefault(key, []).append((t - step, t))
+        windows = short
+
+    gaps = {}
+    for key, ranges in found.items():
+        merged = []
+        for first, last in sorted(ranges):
+            last = min(last, last_times[key])
+            if first > last:
+                continue
+            if merged and first <= merged[-1][1] + 1:
+                merged[-1][1] = max(merged[-1][1], last)
+            else:
+                merged.append([first, last])
+        if merged and merged[0][0] == first_window[key] + 1:
+            merged.pop(0)
+        if merged:
+            gaps[key] = [tuple(r) for r in merged]
+    return gaps
+
+
+## Fetch one range of a device at the channels' resolution and import the samples
+## that fill their gaps. Derived series are computed from their inputs over the
+## same rows. Returns the rows written.
+def repair_range(host, begin, end, gaps, failed):
+    derived = [m for m in gaps if m in sync.derived_all.get(host, [])]
+    measurements = [m for m in gaps if m not in derived]
+    if derived:
+        measurements += [m for m in derived_series.inputs if m not in measurements]
+        input_columns = [measurements.index(m) + 1 for m in derived_series.inputs]
+    query_params = {
+        "select": f"[time.utc.unix,{','.join(measurements)}]",
+        "begin": begin,
+        "end": end,
+        "group": sync.resolution(host, measurements[0]),
+        "missing": "skip",
+        "header": "yes",
+    }
+    governor = sync.governors[host]
+    rows = 0
+
+    ## Import the part of a batch of rows that falls into the gaps
+    def ingest(rows):
+        series = [
+            (measurement, timestamps, values)
+            for measurement, (timestamps, values) in zip(
+                measurements, split_rows(rows, [begin] * len(measurements))
+            )
+        ]
+        if derived:
+            series += derived_series.derive_rows(
+                [[row[0], *(row[c] for c in input_columns)] for row in rows],
+                {name: begin for name in derived},
+            )
+
+        written = 0
+        for measurement, timestamps, values in series:
+            if measurement not in gaps:
+                continue
+            timestamps, values = within(timestamps, values, gaps[measurement])
+            if timestamps:
+                sync.writer.add(
+                    sync.label_sets[(host, measurement)],
+                    timestamps,
+                    values,
+                    on_error=lambda m=measurement: failed.append((host, m)),
+                )
+                written += len(timestamps)
+        return written
+
+    while True:
+        limit = governor.acquire()
+        query_params["limit"] = str(limit)
+        started = time.monotonic()
+        try:
+            response = sync.iotawatt_sessions[host].get(
+                f"{sync.iotawatt_urls[host]}/query", params=query_params, stream=True
+            )
+            with response:
+                if response.status_code != 200:
+                    sync.govern(host, time.monotonic() - started, 0, limit, ok=False)
+                    raise Exception(f"Error fetching data: {response.text}")
+
+                page = QueryStream(
+                    response.iter_content(chunk_size=64 * 1024), sync.stream_batch_bytes
+                )
+                for batch in page:
+                    rows += ingest(batch)
+        except requests.exceptions.RequestException:
+            sync.govern(host, time.monotonic() - started, 0, limit, ok=False)
+            raise
+        sync.govern(host, time.monotonic() - started, page.rows, limit)
+
+        if "limit" not in page.fields:
+            return rows
+        query_params["begin"] = page.fields["limit"]
+
+
+## Re-fetch the gaps of one device. Gaps of channels with the same resolution
+## within merge_window of each other share a query, with every channel that has
+## a gap in it as a column.
+def repair_host(host, host_gaps, failed):
+    batches = []
+    for group, first, last, measurement in sorted(
+        (sync.resolution(host, measurement), first, last, measurement)
+        for measurement, ranges in host_gaps.items()
+        for first, last in ranges
+    ):
+        if (
+            batches
+            and group == batches[-1][3]
+            and first <= batches[-1][1] + merge_window
+        ):
+            batches[-1][1] = max(batches[-1][1], last)
+            batches[-1][2].add(measurement)
+        else:
+            batches.append([first, last, {measurement}, group])
+
+    rows = 0
+    for begin, end, measurements, _ in batches:
+        try:
+            rows += repair_range(
+                host,
+                begin,
+                end,
+                {
+                    m: [r for r in host_gaps[m] if r[1] >= begin and r[0] <= end]
+                    for m in measurements
+                },
+                failed,
+            )
+        except Exception as e:
+            logger.error(f"Failed to repair {sorted(measurements)} on {host}: {e}")
+            failed.extend((host, m) for m in measurements)
+    return rows
+
+
+def repair_window():
+    end = int(time.time()) // 86400 * 86400
+    start = min(map(sync.default_start_time, sync.default_start)) // 86400 * 86400
+    if repair_days:
+        start = max(start, end - repair_days * 86400)
+    return start, end
+
+
+## Find the gaps of every channel in VictoriaMetrics and fill them from the devices.
+## Returns the gaps found and the (host, channel) pairs that couldn't be repaired.
+def repair():
+    start, end = repair_window()
+    last_times = sync.vm_get_last_times()
+    if last_times is None:
+        raise Exception("Could not look up the last imported times")
+    last_times = {
+        (host, measurement): last_times[(host, measurement)]
+        for host, measurements in sync.channels_all.items()
+        for measurement in measurements
+        if (host, measurement) in last_times
+    }
+
+    gaps = find_gaps(start, end, last_times)
+    for (host, measurement), ranges in sorted(gaps.items()):
+        missing = sum((last - first + 1) // 60 for first, last in ranges)
+        logger.info(
+            f"{measurement} on {host}: {len(ranges)} gaps, {missing} missing minutes, "
+            f"first at {datetime.fromtimestamp(ranges[0][0], timezone.utc)}"
+        )
+    if dry_run or not gaps:
+        return gaps, []
+
+    failed = []
+    rows = 0
+    for host in sync.channels_all:
+        host_gaps = {m: r for (h, m), r in gaps.items() if h == host}
+        if host_gaps:
+            rows += repair_host(host, host_gaps, failed)
+    if not sync.writer.flush():
+        logger.error("Final import failed")
+    logger.info(f"Repaired {rows} rows in {len(gaps)} channels")
+    return gaps, sorted(set(failed))
+
+
+if __name__ == "__main__":
+
+    gaps, failed = repair()
+    if failed:
+        logger.error(f"Could not repair {failed}")
+        sys.exit(1)
@@ -1,13 +1,81 @@
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 import requests
-import json
 import logging
+import os
+import threading
 import time
 
+from channel_labels import compile_label_sets
+import derived_series
+from device_governor import DeviceGovernor
+from http_client import make_session
+from rollups import Rollups, compile_rollup_label_sets, is_rollup_key, source_series
+from samples import QueryStream, json_loads, since, split_rows
+from spool import Spool
+from sync_metrics import (
+    bytes_sent,
+    device_page_limit,
+    device_query_seconds,
+    device_request_gap,
+    errors,
+    ingestion_lag,
+    observe_import,
+    pass_duration,
+    resume_lookup_seconds,
+    rows_ingested,
+    spool_records,
+    start_metrics_server,
+)
+from sync_state import SyncState
+from vm_import import make_writer
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 victoriametrics_server = "https://vms-prod-lt.goepp.net"
+# "import" sends JSON lines to /api/v1/import, "remote_write" sends snappy
+# compressed Prometheus remote write protobuf to /api/v1/write
+output_backend = os.environ.get("IOTAWATT_OUTPUT_BACKEND", "import")
+# Local checkpoint of the last committed timestamp per channel
+state_path = os.environ.get("IOTAWATT_STATE_PATH", "iotawatt_sync.db")
+# Fetched pages are spooled here until VictoriaMetrics accepts them
+spool_path = os.environ.get("IOTAWATT_SPOOL_PATH", "spool")
+# Prometheus /metrics endpoint
+metrics_port = int(os.environ.get("IOTAWATT_METRICS_PORT", "9108"))
+# Channels synced at the same time per device, the IoTaWatt web server is small
+device_concurrency = 2
+# Channels whose resume points are this close (seconds) share one IoTaWatt query
+group_window = 3600
+# Channels are due again this long (seconds) after a pass that caught them up
+sync_interval = 60
+# Pages fetched per group in one pass, a group still behind after that is due again at once
+max_pages = 10
+# IoTaWatt group ("1m" or "5s") a channel is fetched at. The devices keep 5s data
+# for about a year. Derived series go with their inputs, which must share one.
+default_resolution = os.environ.get("IOTAWATT_RESOLUTION", "1m")
+channel_resolutions = {
+    "iwatt5": {},
+    "iwatt6": {},
+}
+# Device responses are parsed and imported in batches of about this many bytes
+stream_batch_bytes = 1024 * 1024
+default_start = {
+    "iwatt5": "2021-09-18",
+    "iwatt6": "2023-02-05",
+}
+iotawatt_urls = {host: f"http://{host}.goepp.net" for host in default_start}
+# One pooled keep-alive session per endpoint, a hung device times out instead of blocking
+vm_session = make_session(pool_size=4)
+iotawatt_sessions = {
+    host: make_session(pool_size=device_concurrency, timeout=(5, 120))
+    for host in default_start
+}
+# Page size and request pacing per device, adapted to hold the device's response time
+governors = {host: DeviceGovernor(target_latency=2.0) for host in default_start}
+writer = make_writer(
+    victoriametrics_server, output_backend, session=vm_session, on_send=observe_import
+)
 measurements_all = {
     "iwatt5": [
         "Mains_1",
@@ -42,86 +110,171 @@ measurements_all = {
         "Fridge",
     ],
 }
-
-
-def write_to_vm(host, measurement, data):
-    metric = {}
-    values = []
-    timestamps = []
-
-    metric["__name__"] = "power"
-    metric["location"] = measurement
-    metric["source"] = "iotawatt"
-    metric["device"] = host
-
-    if measurement.startswith("Mains"):
-        metric["pair"] = "Mains"
-        metric["type"] = "Trunk"
-    if measurement.startswith("SolarA"):
-        metric["pair"] = "SolarA"
-        metric["type"] = "Trunk"
-    if measurement.startswith("SolarB"):
-        metric["pair"] = "SolarB"
-        metric["type"] = "Trunk"
-    if measurement.startswith("Solar"):
-        metric["solar"] = "Both"
-    if measurement.startswith("Garage"):
-        metric["pair"] = "Garage"
-        metric["type"] = "Trunk"
-    if measurement.startswith("Minisplit"):
-        metric["hvac"] = "True"
-        metric["minisplit"] = "True"
-    if measurement.startswith("OfficeHeat"):
-        metric["hvac"] = "True"
-    if measurement.startswith("BathroomHeat"):
-        metric["hvac"] = "True"
-    if measurement.startswith("Furnace"):
-        metric["hvac"] = "True"
-
-    if "type" not in metric:
-        metric["type"] = "Circuit"
-
-    for entry in data:
-        values.append(float(entry[1]))
-        timestamps.append(int(entry[0] * 1000))
-
-    data_point = {
-        "metric": metric,
-        "values": values,
-        "timestamps": timestamps,
-    }
-
-    try:
-        write_response = requests.post(
-            f"{victoriametrics_server}/api/v1/import",
-            data=json.dumps(data_point),
-            headers={"Content-Type": "application/json"},
-        )
-        write_response.raise_for_status()
-
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Error during API request: {e}")
-
-
-## Get the last time data was fetched
-def vm_get_last_time(measurment):
+# Series computed from a device's channels while they are ingested
+derived_all = {"iwatt5": derived_series.names}
+# Every series with a watermark, raw channels and derived series
+channels_all = {
+    host: measurements + derived_all.get(host, [])
+    for host, measurements in measurements_all.items()
+}
+# Device of every series, channel names are unique across devices. Series from
+# the original transform carry no device label, so they are matched by location.
+channel_hosts = {
+    measurement: host
+    for host, measurements in channels_all.items()
+    for measurement in measurements
+}
+label_sets = {
+    **compile_label_sets(measurements_all),
+    **compile_label_sets(
+        derived_all, derived_series.rules, metric_name=derived_series.metric_name
+    ),
+}
+# Hourly and daily energy_wh rollups of every channel and derived series
+label_sets.update(compile_rollup_label_sets(label_sets))
+
+
+## Last imported timestamp per (host, measurement), kept between passes
+class Watermarks:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.times = {}
+        self.fetched = {}
+        self.state = None
+
+    ## Persist watermarks to a checkpoint store and resume from what it holds
+    def attach(self, state):
+        self.state = state
+        for (host, measurement), last_time in state.get_watermarks().items():
+            self.advance(host, measurement, last_time)
+
+    def get(self, host, measurement):
+        with self.lock:
+            return self.times.get((host, measurement))
+
+    ## Where the next device query starts: past what is imported or safely spooled
+    def resume_time(self, host, measurement):
+        with self.lock:
+            times = [
+                t
+                for t in (
+                    self.times.get((host, measurement)),
+                    self.fetched.get((host, measurement)),
+                )
+                if t is not None
+            ]
+        return max(times) if times else None
+
+    def advance_fetched(self, host, measurement, last_time):
+        with self.lock:
+            if last_time > self.fetched.get((host, measurement), float("-inf")):
+                self.fetched[(host, measurement)] = last_time
+
+    def missing(self):
+        with self.lock:
+            return [
+                (host, measurement)
+                for host, measurements in channels_all.items()
+                for measurement in measurements
+                if (host, measurement) not in self.times
+            ]
+
+    ## Only ever moves forward, imports from parallel groups can land out of order
+    def advance(self, host, measurement, last_time):
+        with self.lock:
+            if last_time <= self.times.get((host, measurement), float("-inf")):
+                return
+            self.times[(host, measurement)] = last_time
+            if self.state is not None:
+                self.state.set_watermark(host, measurement, last_time)
+
+
+watermarks = Watermarks()
+rollups = Rollups()
+spool = None
+
+
+## Spool a page's series before import so a failed import is replayed from disk
+## instead of being fetched from the device again
+def spool_series(host, series):
+    if spool is None:
+        return [None] * len(series)
+    record_ids = spool.append(
+        [
+            (host, measurement, timestamps, values)
+            for measurement, timestamps, values in series
+        ]
+    )
+    for measurement, timestamps, _ in series:
+        if not is_rollup_key(measurement):
+            watermarks.advance_fetched(host, measurement, timestamps[-1] // 1000)
+    return record_ids
+
+
+## Re-import spooled series whose import failed or never finished
+def replay_spool():
+    if spool is None:
+        return
+    records = spool.replay()
+    if records:
+        logger.info(f"Replaying {len(records)} spooled series")
+    for record_id, host, measurement, timestamps, values in records:
+        write_to_vm(host, measurement, timestamps, values, record_id)
+
+
+## Import one series. Rollups only bring their buckets in, the watermarks and
+## the metrics are their channel's.
+def write_to_vm(host, measurement, timestamps, values, record_id=None):
+    last_time = timestamps[-1] // 1000
+    rows = len(timestamps)
+    channel = source_series(measurement)
+
+    def committed():
+        if not is_rollup_key(measurement):
+            watermarks.advance(host, measurement, last_time)
+        rows_ingested.labels(host, channel).inc(rows)
+        if record_id is not None:
+            spool.ack(record_id)
+
+    def failed():
+        errors.labels(host, channel, "import").inc()
+        if record_id is not None:
+            spool.release(record_id)
+
+    size = writer.add(
+        label_sets[(host, measurement)],
+        timestamps,
+        values,
+        on_commit=committed,
+        on_error=failed,
+    )
+    bytes_sent.labels(host, channel).inc(size)
+
+
+## Get the last time data was fetched for every channel in one query
+def vm_get_last_times():
 
     try:
         params = {
-            "query": f'tlast_over_time(power{{location="{measurment}"}})',
-            "step": "30d",
+            "query": 'max(tlast_over_time({__name__=~"power|power_derived",source="iotawatt"}[30d])) by (location)',
         }
 
-        response = requests.get(f"{victoriametrics_server}/api/v1/query", params=params)
+        with resume_lookup_seconds.time():
+            response = vm_session.get(
+                f"{victoriametrics_server}/api/v1/query", params=params
+            )
 
         if response.status_code != 200:
             raise Exception(f"Error fetching data: {response.text}")
 
-        if not response.json()["data"]["result"]:
-            raise Exception(f"No data found for {measurment}")
-
-        start_time = int(response.json()["data"]["result"][0]["value"][1])
-        return start_time
+        last_times = {}
+        for result in json_loads(response.content)["data"]["result"]:
+            location = result["metric"].get("location")
+            if location in channel_hosts:
+                last_times[(channel_hosts[location], location)] = int(
+                    float(result["value"][1])
+                )
+        return last_times
 
     except requests.exceptions.RequestException as e:
         logger.error(f"Error during API request: {e}")
@@ -129,71 +282,344 @@ def vm_get_last_time(measurment):
         logger.error(f"Error processing data: {e}")
 
 
-## Get the data from IoTaWatt
-def vm_get_iotawatt_data(host, measurement, start_time):
-
-    response = {}
+## Fill the watermark cache from VictoriaMetrics for channels it doesn't know yet
+def refresh_watermarks():
+    missing = watermarks.missing()
+    if not missing:
+        return
+
+    last_times = vm_get_last_times()
+    if last_times is None:
+        return
+
+    # Derived series go last, a new one starts where its inputs are and leaves
+    # the history before that to the backfill
+    missing.sort(key=lambda key: key[1] in derived_all.get(key[0], []))
+    for host, measurement in missing:
+        if (host, measurement) in last_times:
+            watermarks.advance(host, measurement, last_times[(host, measurement)])
+        elif measurement in derived_all.get(host, []):
+            last_time = min(watermarks.get(host, m) for m in derived_series.inputs)
+            logger.warning(
+                f"No last time found for {measurement} - starting from its inputs "
+                f"at {datetime.fromtimestamp(last_time, timezone.utc)}"
+            )
+            watermarks.advance(host, measurement, last_time)
+        else:
+            logger.warning(
+                f"No last time found for {measurement} - using {default_start[host]}"
+            )
+            watermarks.advance(host, measurement, default_start_time(host) - 5)
+
+
+## Get the data from IoTaWatt, all channels of a group in one query at their
+## resolution, and compute any derived series of the group from the same aligned
+## rows. Every series also runs through its energy rollup, which may start
+## further back if its checkpoint is behind the import. Each page is parsed as it
+## streams in and imported in batches, so memory doesn't grow with the page size.
+## Returns True when the device still has more data for the group.
+def vm_get_iotawatt_data(host, start_times):
+
+    derived = [name for name in derived_all.get(host, []) if name in start_times]
+    measurements = [m for m in start_times if m not in derived]
+    if derived:
+        input_columns = [measurements.index(m) + 1 for m in derived_series.inputs]
+    feed_starts = dict(start_times)
+    for measurement, start_time in start_times.items():
+        rollup_time = rollups.resume_time(host, measurement)
+        if rollup_time is not None:
+            feed_starts[measurement] = min(start_time, rollup_time + 5)
     query_params = {
-        "select": f"[time.utc.unix,{measurement}]",
-        "begin": start_time,
+        "select": f"[time.utc.unix,{','.join(measurements)}]",
+        "begin": min(feed_starts.values()),
         "end": "s",
-        "group": "1m",
+        "group": resolution(host, measurements[0]),
         "missing": "skip",
-        "limit": "5000",
         "header": "yes",
     }
+    governor = governors[host]
+
+    ## Import one batch of rows
+    def ingest(rows):
+        fed = [
+            (measurement, timestamps, values)
+            for measurement, (timestamps, values) in zip(
+                measurements,
+                split_rows(rows, [feed_starts[m] for m in measurements]),
+            )
+        ]
+        if derived:
+            fed += derived_series.derive_rows(
+                [[row[0], *(row[c] for c in input_columns)] for row in rows],
+                {name: feed_starts[name] for name in derived},
+            )
 
-    while True:
-        if response != {}:
-            if "limit" in response.json().keys():
-                query_params["begin"] = response.json()["limit"]
-            else:
-                break
-
-        if isinstance(query_params["begin"], str):
-            show_time = query_params["begin"]
-        else:
-            show_time = datetime.fromtimestamp(query_params["begin"])
+        series = []
+        rollup_states = {}
+        for measurement, timestamps, values in fed:
+            rollup_states[measurement], closed = rollups.feed(
+                host, measurement, timestamps, values
+            )
+            series.append(
+                (measurement, *since(timestamps, values, start_times[measurement]))
+            )
+            series += closed
+        series = [s for s in series if s[1]]
 
-        # logger.info(f"Transferring {measurement} from {show_time} on {host}")
+        record_ids = spool_series(host, series)
+        rollups.commit(host, rollup_states)
+        for (measurement, timestamps, values), record_id in zip(series, record_ids):
+            write_to_vm(host, measurement, timestamps, values, record_id)
 
-        try:
-            response = requests.get(
-                f"http://{host}.goepp.net/query", params=query_params
-            )
+    for _ in range(max_pages):
+        show_time = datetime.fromtimestamp(query_params["begin"])
+
+        # logger.info(f"Transferring {measurements} from {show_time} on {host}")
 
-            if response.status_code != 200:
-                raise Exception(f"Error fetching data: {response.text}")
+        limit = governor.acquire()
+        query_params["limit"] = str(limit)
+        started = time.monotonic()
 
-            if response.json()["data"] == []:
-                raise Exception("No new data available")
+        try:
+            try:
+                response = iotawatt_sessions[host].get(
+                    f"{iotawatt_urls[host]}/query", params=query_params, stream=True
+                )
+                with response:
+                    if response.status_code != 200:
+                        govern(host, time.monotonic() - started, 0, limit, ok=False)
+                        raise Exception(f"Error fetching data: {response.text}")
+
+                    page = QueryStream(
+                        response.iter_content(chunk_size=64 * 1024), stream_batch_bytes
+                    )
+                    for rows in page:
+                        ingest(rows)
+            except requests.exceptions.RequestException:
+                govern(host, time.monotonic() - started, 0, limit, ok=False)
+                raise
+
+            govern(host, time.monotonic() - started, page.rows, limit)
 
-            write_to_vm(host, measurement, response.json()["data"])
+            if page.rows == 0:
+                logger.debug(f"No new data available for {measurements} on {host}")
+                return False
 
         except Exception as e:
             logger.error(f"Failed to fetch data from IoTaWatt: {str(e)}")
-            break
+            for measurement in measurements:
+                errors.labels(host, measurement, "query").inc()
+            return False
 
-        # time.sleep(1)
+        if "limit" not in page.fields:
+            return False
+        query_params["begin"] = page.fields["limit"]
 
+    return True
 
-if __name__ == "__main__":
 
-    while True:
-        logger.info(f"Running sync {datetime.now().isoformat('T', 'seconds')}")
-        for host, measurements in measurements_all.items():
+## Feed a device query result, timed until its response was consumed, back
+## into the device's governor
+def govern(host, seconds, rows, limit, ok=True):
+    device_query_seconds.labels(host).observe(seconds)
+    governor = governors[host]
+    governor.record(seconds, rows, limit, ok)
+    device_page_limit.labels(host).set(governor.limit)
+    device_request_gap.labels(host).set(governor.gap)
+
+
+## IoTaWatt group a channel is fetched at, derived series use their inputs'
+def resolution(host, measurement):
+    if measurement in derived_all.get(host, []):
+        measurement = derived_series.inputs[0]
+    return channel_resolutions.get(host, {}).get(measurement, default_resolution)
+
+
+def default_start_time(host):
+    return int(
+        datetime.fromisoformat(default_start[host])
+        .replace(tzinfo=timezone.utc)
+        .timestamp()
+    )
+
+
+## Resume point for each channel, skipping channels with no known watermark
+def get_start_times(host, measurements):
+    start_times = {}
+    for measurement in measurements:
+        last_time = watermarks.resume_time(host, measurement)
+        if last_time is not None:
+            start_times[measurement] = last_time + 5
+        else:
+            logger.warning(f"No last time known for {measurement} - skipping this pass")
+    return start_times
+
+
+## Group channels whose resume points are within group_window of each other.
+## Channels in together always end up in the same group.
+def group_start_times(start_times, together=()):
+    groups = []
+    for measurement, start_time in sorted(start_times.items(), key=lambda i: i[1]):
+        if groups and start_time - min(groups[-1].values()) <= group_window:
+            groups[-1][measurement] = start_time
+        else:
+            groups.append({measurement: start_time})
+
+    if not together:
+        return groups
+    apart, joined = [], {}
+    for group in groups:
+        if set(together).isdisjoint(group):
+            apart.append(group)
+        else:
+            joined.update(group)
+    return apart + [joined] if joined else apart
+
+
+## Derived series are computed from their inputs' rows, so a due derived series
+## brings its inputs into the query and is skipped if any input can't be fetched
+def add_derived_inputs(host, measurements, start_times):
+    derived = [m for m in measurements if m in derived_all.get(host, [])]
+    if not derived:
+        return start_times
+    if len({resolution(host, m) for m in derived_series.inputs}) > 1:
+        logger.error(f"Inputs of {derived} on {host} have different resolutions")
+        return {m: t for m, t in start_times.items() if m not in derived}
+
+    missing = [m for m in derived_series.inputs if m not in measurements]
+    start_times = {
+        **start_times,
+        **get_start_times(host, missing),
+    }
+    if any(m not in start_times for m in derived_series.inputs):
+        logger.warning(f"Inputs of {derived} unknown on {host} - skipping this pass")
+        for name in derived:
+            start_times.pop(name, None)
+    return start_times
+
+
+## Sync channels of a device, limited to device_concurrency queries at a time.
+## Returns the channels that are still behind.
+def sync_host(host, measurements):
+    start_times = add_derived_inputs(
+        host, measurements, get_start_times(host, measurements)
+    )
+    derived = [m for m in derived_all.get(host, []) if m in start_times]
+    # One query per resolution, so groups are formed per resolution
+    by_resolution = {}
+    for measurement, start_time in start_times.items():
+        resolution_group = by_resolution.setdefault(resolution(host, measurement), {})
+        resolution_group[measurement] = start_time
+    groups = [
+        group
+        for resolution_start_times in by_resolution.values()
+        for group in group_start_times(
+            resolution_start_times, derived_series.inputs + derived if derived else ()
+        )
+    ]
+    behind = set()
+    with ThreadPoolExecutor(
+        max_workers=device_concurrency, thread_name_prefix=host
+    ) as executor:
+        futures = [
+            executor.submit(vm_get_iotawatt_data, host, group) for group in groups
+        ]
+        for group, future in zip(groups, futures):
+            try:
+                if future.result():
+                    behind.update((host, measurement) for measurement in group)
+            except Exception as e:
+                logger.error(f"Sync failed for {list(group)} on {host}: {e}")
+    return behind
+
+
+## Sync the given channels of all devices in parallel
+def sync_all(measurements=channels_all):
+    refresh_watermarks()
+    replay_spool()
+    behind = set()
+    with ThreadPoolExecutor(max_workers=len(measurements)) as executor:
+        futures = [
+            executor.submit(sync_host, host, host_measurements)
+            for host, host_measurements in measurements.items()
+        ]
+        for future in futures:
+            behind.update(future.result())
+    writer.flush()
+    return behind
+
+
+## Next due time per channel, a channel still behind is due again immediately
+class Scheduler:
+    def __init__(self):
+        now = time.time()
+        self.next_due = {
+            (host, measurement): now
+            for host, measurements in channels_all.items()
+            for measurement in measurements
+        }
+
+    def due(self, now):
+        due = {}
+        for (host, measurement), due_time in self.next_due.items():
+            if due_time <= now:
+                due.setdefault(host, []).append(measurement)
+        return due
+
+    def reschedule(self, due, behind, now):
+        for host, measurements in due.items():
             for measurement in measurements:
-                start_time = vm_get_last_time(measurement)
-                if start_time is not None:
-                    vm_get_iotawatt_data(host, measurement, start_time + 5)
+                if (host, measurement) in behind:
+                    self.next_due[(host, measurement)] = now
                 else:
-                    if host == "iwatt6":
-                        start_time = "2023-02-05"
-                    elif host == "iwatt5":
-                        start_time = "2021-09-18"
-                    logger.warning(
-                        f"No last time found for {measurement} - using {start_time}"
-                    )
-                    vm_get_iotawatt_data(host, measurement, start_time)
-        logger.info(f"Done at {datetime.now().isoformat('T', 'seconds')} - Sleep 5m")
-        time.sleep(300)
+                    self.next_due[(host, measurement)] = now + sync_interval
+
+    def next_deadline(self):
+        return min(self.next_due.values())
+
+
+## Largest gap between now and the last imported point of the given channels,
+## also exported per channel as the lag gauge
+def max_lag(measurements, now):
+    lag = 0
+    for host, host_measurements in measurements.items():
+        for measurement in host_measurements:
+            last_time = watermarks.get(host, measurement)
+            if last_time is not None:
+                ingestion_lag.labels(host, measurement).set(now - last_time)
+                lag = max(lag, now - last_time)
+    return lag
+
+
+if __name__ == "__main__":
+
+    state = SyncState(state_path)
+    watermarks.attach(state)
+    rollups.attach(state)
+    spool = Spool(spool_path)
+    for (host, measurement), last_time in spool.last_times().items():
+        if not is_rollup_key(measurement):
+            watermarks.advance_fetched(host, measurement, last_time)
+    start_metrics_server(metrics_port)
+    scheduler = Scheduler()
+
+    while True:
+        now = time.time()
+        due = scheduler.due(now)
+        if not due:
+            time.sleep(max(0, scheduler.next_deadline() - now))
+            continue
+
+        lag_before = max_lag(due, now)
+        behind = sync_all(due)
+        done = time.time()
+        scheduler.reschedule(due, behind, done)
+        lag_after = max_lag(due, done)
+        pass_duration.set(done - now)
+        spool_records.set(spool.size())
+
+        logger.info(
+            f"Synced {sum(map(len, due.values()))} channels in {done - now:.1f}s, "
+            f"lag {lag_before:.0f}s -> {lag_after:.0f}s"
+            + (f", {len(behind)} still behind" if behind else "")
+        )
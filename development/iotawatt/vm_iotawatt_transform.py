@@ -1,14 +1,63 @@
 #!/usr/bin/env python3
 
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 import logging
-import json
+import os
+import sys
+import threading
+import time
+
+from channel_labels import compile_label_sets
+import derived_series
+from http_client import make_session
+from rollups import (
+    RollupState,
+    compile_rollup_label_sets,
+    finish,
+    integrate,
+    rollup_key,
+)
+from samples import json_loads, rows_to_arrays
+from sync_state import SyncState
+from vm_import import make_writer
 
 # Configure logger
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+vm_url = "https://vms-prod-lt.goepp.net"
+# "import" (JSON lines) or "remote_write" (snappy compressed protobuf)
+output_backend = os.environ.get("IOTAWATT_OUTPUT_BACKEND", "import")
+end_time = "2025-01-31T23:59:59+00:00"
+# "export" streams raw samples from /api/v1/export, "query_range" resamples at source_step
+source_mode = "export"
+source_step = "1m"
+target_step = "1m"
+# Inputs of derived series are joined on their timestamps rounded down to this
+align_seconds = 60
+# query_range responses are capped at the point limit, export has no such limit.
+# A chunk only counts as done if one with the same start and end was recorded, so
+# after changing the chunk size the chunks are loaded again.
+chunk_size_days = 90 if source_mode == "export" else 7
+# A derived chunk holds all its input series in memory at once, so it is kept short
+derived_chunk_size_days = 7
+# Only write the hourly and daily energy_wh rollups, for history that is already
+# backfilled. Rollup chunks are recorded in the state file separately.
+rollups_only = False
+# Only backfill the derived series, when the channels' history is already loaded
+# and importing it again would leave a second copy of every series
+derived_only = False
+# Chunks queried and imported at the same time
+workers = 4
+# Finished chunks are recorded here so a restarted backfill skips them
+state_path = os.environ.get("IOTAWATT_STATE_PATH", "iotawatt_transform.db")
+vm_session = make_session(pool_size=workers, timeout=(5, 300))
+start_times = {
+    "iwatt5": "2021-09-18T00:00:00+00:00",
+    "iwatt6": "2023-02-05T00:00:00+00:00",
+}
 measurements_all = {
     "iwatt5": [
         "Mains_1",
@@ -43,6 +92,17 @@ measurements_all = {
         "Fridge",
     ],
 }
+# Series computed from a device's channels, backfilled together as one task
+derived_all = {"iwatt5": derived_series.names}
+# Holds the chunk size, so derived chunks recorded at another size aren't skipped
+derived_task = f"derived:{derived_chunk_size_days}d"
+label_sets = {
+    **compile_label_sets(measurements_all),
+    **compile_label_sets(
+        derived_all, derived_series.rules, metric_name=derived_series.metric_name
+    ),
+}
+label_sets.update(compile_rollup_label_sets(label_sets))
 
 
 def get_time_chunks(start_time, end_time, chunk_size_days):
@@ -58,108 +118,312 @@ def get_time_chunks(start_time, end_time, chunk_size_days):
         current_start = current_end + 1
 
 
+## Records chunks in the state file once VictoriaMetrics accepted all of them,
+## and logs the chunks done, rows written and an ETA for the remaining chunks
+class Progress:
+    def __init__(self, state, total):
+        self.lock = threading.Lock()
+        self.state = state
+        self.total = total
+        self.done = 0
+        self.rows = 0
+        self.started = time.monotonic()
+
+    def mark_chunk_done(self, host, measurement, chunk_start, chunk_end, rows):
+        self.state.mark_chunk_done(host, measurement, chunk_start, chunk_end, rows)
+        with self.lock:
+            self.done += 1
+            self.rows += rows
+            elapsed = time.monotonic() - self.started
+            eta = (self.total - self.done) * elapsed / self.done
+            logger.info(
+                f"Progress: {self.done}/{self.total} chunks, "
+                f"{self.rows / elapsed:.0f} rows/s, "
+                f"ETA {timedelta(seconds=round(eta))}"
+            )
+
+
+## Every (host, measurement, chunk) not already recorded as done with the same
+## bounds, derived series are one task per device and chunk
+def get_tasks(state):
+    done = state.get_done_chunks()
+    return [
+        (host, measurement, chunk_start, chunk_end)
+        for host, measurements in measurements_all.items()
+        for measurement in ([] if derived_only else measurements)
+        + ([derived_task] if host in derived_all else [])
+        for chunk_start, chunk_end in get_time_chunks(
+            start_times[host],
+            end_time,
+            derived_chunk_size_days if measurement == derived_task else chunk_size_days,
+        )
+        if (host, chunk_key(measurement), int(chunk_start), int(chunk_end))
+        not in done
+    ]
+
+
+## What a task is recorded as in the state file
+def chunk_key(measurement):
+    return f"{measurement}:rollups" if rollups_only else measurement
+
+
+## Rename an old Power_ series and add the same labels the sync writes
+def relabel(metric, host, measurement):
+    return {**metric, **label_sets[(host, measurement)].metric}
+
+
+## Stream raw series blocks for a chunk from /api/v1/export, one JSON line at a time
+def vm_export(match, chunk_start, chunk_end):
+    params = {
+        "match[]": match,
+        "start": chunk_start,
+        "end": chunk_end,
+    }
+
+    with vm_session.get(f"{vm_url}/api/v1/export", params=params, stream=True) as response:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if line:
+                yield json_loads(line)
+
+
+## Hourly and daily energy_wh rollups of one series over one chunk. Chunks
+## start on a day boundary, so every bucket of the chunk is whole.
+class ChunkRollup:
+    def __init__(self, writer, chunk, host, measurement, chunk_start, chunk_end):
+        self.writer = writer
+        self.chunk = chunk
+        self.host = host
+        self.measurement = measurement
+        self.chunk_end = int(chunk_end)
+        self.state = RollupState.starting_at(int(chunk_start))
+
+    def add(self, timestamps, values):
+        self.state, closed = integrate(self.state, timestamps, values)
+        self._write(closed)
+
+    ## Count the last sample up to the end of the chunk
+    def close(self):
+        self.state, closed = finish(self.state, self.chunk_end + 1)
+        self._write(closed)
+
+    def _write(self, closed):
+        for resolution, (timestamps, values) in closed.items():
+            self.writer.add(
+                label_sets[(self.host, rollup_key(self.measurement, resolution))],
+                timestamps,
+                values,
+                on_commit=self.chunk.add(),
+            )
+
+
+## Tracks the import of a chunk sent as many series blocks
+class ChunkCommit:
+    def __init__(self, on_done):
+        self.lock = threading.Lock()
+        self.on_done = on_done
+        self.pending = 0
+        self.sealed = False
+
+    def add(self):
+        with self.lock:
+            self.pending += 1
+        return self.commit
+
+    def commit(self):
+        with self.lock:
+            self.pending -= 1
+            done = self.sealed and self.pending == 0
+        if done:
+            self.on_done()
+
+    ## No more blocks will be added
+    def seal(self):
+        with self.lock:
+            self.sealed = True
+            done = self.pending == 0
+        if done:
+            self.on_done()
+
+
+## Pipe one chunk of an old Power_ series from export straight into import
+def backfill_chunk_export(writer, state, host, measurement, chunk_start, chunk_end):
+    rows = 0
+    chunk = ChunkCommit(
+        lambda: state.mark_chunk_done(
+            host, chunk_key(measurement), chunk_start, chunk_end, rows
+        )
+    )
+    rollup = ChunkRollup(writer, chunk, host, measurement, chunk_start, chunk_end)
+
+    for block in vm_export(f"Power_{measurement}", chunk_start, chunk_end):
+        if not rollups_only:
+            writer.add(
+                relabel(block["metric"], host, measurement),
+                block["timestamps"],
+                block["values"],
+                on_commit=chunk.add(),
+            )
+        rollup.add(block["timestamps"], block["values"])
+        rows += len(block["values"])
+    rollup.close()
+
+    logger.info(
+        f"Write: {host} - {measurement} {datetime.fromtimestamp(chunk_start,tz=timezone.utc)} to {datetime.fromtimestamp(chunk_end,tz=timezone.utc)}: {rows}"
+    )
+    chunk.seal()
+    return rows
+
+
+## Copy one chunk of an old Power_ series into the new power series
+def backfill_chunk(writer, state, host, measurement, chunk_start, chunk_end):
+
+    params = {
+        "query": f"Power_{measurement}",
+        "start": chunk_start,
+        "end": chunk_end,
+        "step": source_step,
+    }
+
+    response = vm_session.get(f"{vm_url}/api/v1/query_range", params=params)
+    response.raise_for_status()
+
+    if response.status_code != 200:
+        raise Exception(f"Error fetching data: {response.text}")
+
+    page = json_loads(response.content)
+
+    if "data" not in page:
+        raise ValueError("No data found in response")
+
+    if len(page["data"]["result"]) == 0:
+        state.mark_chunk_done(host, chunk_key(measurement), chunk_start, chunk_end, 0)
+        return 0
+
+    result = page["data"]["result"][0]
+
+    metric = relabel(result["metric"], host, measurement)
+
+    timestamps, values = rows_to_arrays(result["values"])
+
+    logger.info(
+        f"Write: {host} - {measurement} {datetime.fromtimestamp(chunk_start,tz=timezone.utc)} to {datetime.fromtimestamp(chunk_end,tz=timezone.utc)}: {len(values)}"
+    )
+    rows = len(values)
+    chunk = ChunkCommit(
+        lambda: state.mark_chunk_done(
+            host, chunk_key(measurement), chunk_start, chunk_end, rows
+        )
+    )
+    if not rollups_only:
+        writer.add(metric, timestamps, values, on_commit=chunk.add())
+    rollup = ChunkRollup(writer, chunk, host, measurement, chunk_start, chunk_end)
+    rollup.add(timestamps, values)
+    rollup.close()
+    chunk.seal()
+    return rows
+
+
+## Values of an old Power_ series in a chunk, keyed by unix time aligned to align_seconds
+def vm_aligned(measurement, chunk_start, chunk_end):
+    aligned = {}
+    if source_mode == "export":
+        for block in vm_export(f"Power_{measurement}", chunk_start, chunk_end):
+            for timestamp, value in zip(block["timestamps"], block["values"]):
+                aligned[timestamp // 1000 // align_seconds * align_seconds] = value
+        return aligned
+
+    params = {
+        "query": f"Power_{measurement}",
+        "start": chunk_start,
+        "end": chunk_end,
+        "step": source_step,
+    }
+    response = vm_session.get(f"{vm_url}/api/v1/query_range", params=params)
+    response.raise_for_status()
+    for result in json_loads(response.content)["data"]["result"]:
+        for timestamp, value in result["values"]:
+            aligned[int(timestamp) // align_seconds * align_seconds] = float(value)
+    return aligned
+
+
+## Compute one chunk of every derived series from the old Power_ input series,
+## joined on aligned timestamps
+def backfill_chunk_derived(writer, state, host, measurement, chunk_start, chunk_end):
+    columns = [
+        vm_aligned(input_measurement, chunk_start, chunk_end)
+        for input_measurement in derived_series.inputs
+    ]
+    times = sorted(set(columns[0]).intersection(*columns[1:]))
+    series = derived_series.derive_rows(
+        [[t, *(column[t] for column in columns)] for t in times],
+        {name: chunk_start for name in derived_all[host]},
+    )
+
+    rows = sum(len(values) for _, _, values in series)
+    chunk = ChunkCommit(
+        lambda: state.mark_chunk_done(
+            host, chunk_key(measurement), chunk_start, chunk_end, rows
+        )
+    )
+    for name, timestamps, values in series:
+        if not rollups_only:
+            writer.add(
+                label_sets[(host, name)], timestamps, values, on_commit=chunk.add()
+            )
+        rollup = ChunkRollup(writer, chunk, host, name, chunk_start, chunk_end)
+        rollup.add(timestamps, values)
+        rollup.close()
+
+    logger.info(
+        f"Write: {host} - {measurement} {datetime.fromtimestamp(chunk_start,tz=timezone.utc)} to {datetime.fromtimestamp(chunk_end,tz=timezone.utc)}: {rows}"
+    )
+    chunk.seal()
+    return rows
+
+
+## Run one chunk, its progress is counted when its imports are committed
+def run_task(writer, progress, task):
+    try:
+        if task[1] == derived_task:
+            backfill_chunk_derived(writer, progress, *task)
+        elif source_mode == "export":
+            backfill_chunk_export(writer, progress, *task)
+        else:
+            backfill_chunk(writer, progress, *task)
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Error during API request: {e}")
+    except Exception as e:
+        logger.error(f"Error processing data: {e}")
+
+
+## Run every remaining chunk on the worker pool. Returns the number of chunks
+## that failed to be fetched or imported and are left for the next run.
+def backfill(state, writer):
+    tasks = get_tasks(state)
+    logger.info(f"Backfilling {len(tasks)} chunks with {workers} workers")
+    progress = Progress(state, len(tasks))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for task in tasks:
+            executor.submit(run_task, writer, progress, task)
+
+    writer.flush()
+    left = len(tasks) - progress.done
+    if left:
+        logger.error(f"{left} of {len(tasks)} chunks failed, run again to retry them")
+    return left
+
+
 if __name__ == "__main__":
 
-    vm_url = f"https://vms-prod-lt.goepp.net/"
-    end_time = "2025-01-31T23:59:59+00:00"
-    source_step = "1m"
-    target_step = "1m"
-    chunk_size_days = 7
-
-    for host, measurements in measurements_all.items():
-
-        if host == "iwatt5":
-            start_time = "2021-09-18T00:00:00+00:00"
-        elif host == "iwatt6":
-            start_time = "2023-02-05T00:00:00+00:00"
-
-        for measurement in measurements:
-
-            for chunk_start, chunk_end in get_time_chunks(
-                start_time, end_time, chunk_size_days
-            ):
-
-                try:
-
-                    params = {
-                        "query": f"Power_{measurement}",
-                        "start": chunk_start,
-                        "end": chunk_end,
-                        "step": source_step,
-                    }
-
-                    response = requests.get(
-                        f"{vm_url}api/v1/query_range", params=params
-                    )
-                    response.raise_for_status()
-
-                    if response.status_code != 200:
-                        raise Exception(f"Error fetching data: {response.text}")
-
-                    if (
-                        "data" not in response.json()
-                        or len(response.json()["data"]["result"]) == 0
-                    ):
-                        raise ValueError("No data found in response")
-
-                    result = response.json()["data"]["result"][0]
-
-                    metric = result["metric"].copy()
-                    metric["__name__"] = "power"
-                    metric["location"] = measurement
-                    metric["source"] = "iotawatt"
-
-                    if measurement.startswith("Mains"):
-                        metric["pair"] = "Mains"
-                        metric["type"] = "Trunk"
-                    if measurement.startswith("SolarA"):
-                        metric["pair"] = "SolarA"
-                        metric["type"] = "Trunk"
-                    if measurement.startswith("SolarB"):
-                        metric["pair"] = "SolarB"
-                        metric["type"] = "Trunk"
-                    if measurement.startswith("Solar"):
-                        metric["solar"] = "Both"
-                    if measurement.startswith("Garage"):
-                        metric["pair"] = "Garage"
-                        metric["type"] = "Trunk"
-                    if measurement.startswith("Minisplit"):
-                        metric["hvac"] = "True"
-                        metric["minisplit"] = "True"
-                    if measurement.startswith("OfficeHeat"):
-                        metric["hvac"] = "True"
-                    if measurement.startswith("BathroomHeat"):
-                        metric["hvac"] = "True"
-                    if measurement.startswith("Furnace"):
-                        metric["hvac"] = "True"
-
-                    if "type" not in metric:
-                        metric["type"] = "Circuit"
-
-                    values = []
-                    timestamps = []
-
-                    for timestamp, value in result["values"]:
-                        values.append(float(value))
-                        timestamps.append(int(timestamp * 1000))
-
-                    data_point = {
-                        "metric": metric,
-                        "values": values,
-                        "timestamps": timestamps,
-                    }
-
-                    logger.info(
-                        f"Write: {host} - {measurement} {datetime.fromtimestamp(chunk_start,tz=timezone.utc)} to {datetime.fromtimestamp(chunk_end,tz=timezone.utc)}: {len(data_point['values'])}"
-                    )
-                    write_response = requests.post(
-                        f"{vm_url}/api/v1/import",
-                        data=json.dumps(data_point),
-                        headers={"Content-Type": "application/json"},
-                    )
-                    write_response.raise_for_status()
-
-                except requests.exceptions.RequestException as e:
-                    logger.error(f"Error during API request: {e}")
-                except Exception as e:
-                    logger.error(f"Error processing data: {e}")
+    state = SyncState(state_path)
+    writer = make_writer(
+        vm_url,
+        output_backend,
+        max_bytes=16 * 1024 * 1024,
+        max_age=60,
+        session=make_session(pool_size=workers, timeout=(5, 300)),
+    )
+    if backfill(state, writer):
+        sys.exit(1)